@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import os
+import shutil
+
+
+ATLAS_DIRECTORY = r"\\allen\programs\mindscope\workgroups\np-behavior"
+#ATLAS_DIRECTORY = '/mnt/md0/data/opt/template_brain'
+
+ATLAS_FILES = {'template': 'template_fluor.pvl.nc.001',
+               'labels': 'annotation_volume_10um_by_index.npy',
+               'structure_tree': 'ccf_structure_tree_2017.csv',
+               'template_landmarks': 'template_landmark_annotations.npy'}
+
+DEFAULT_CACHE_DIRECTORY = os.environ.get('OPT_ATLAS_CACHE',
+    os.path.join(os.path.expanduser('~'), '.opt_atlas_cache'))
+
+
+class AtlasCache:
+
+    """
+    Local copies of the template, label volume, structure tree and template landmarks
+
+    Each file is copied from the atlas directory the first time it is needed, and
+    again only if the original changes. Assets are loaded lazily: the label volume
+    and template are memory-mapped, so only the voxels actually looked up are read.
+
+    Parameters
+    ==========
+    atlas_directory - where the original files live (network share)
+    cache_directory - local copy location (default = $OPT_ATLAS_CACHE or ~/.opt_atlas_cache)
+
+    """
+
+    def __init__(self, atlas_directory=ATLAS_DIRECTORY, cache_directory=DEFAULT_CACHE_DIRECTORY):
+
+        self.atlas_directory = atlas_directory
+        self.cache_directory = cache_directory
+
+        self._loaded = {}
+
+    def path(self, name):
+
+        """
+        Local path of an atlas file, copying it into the cache first if needed
+
+        Parameters
+        ==========
+        name - key of ATLAS_FILES
+
+        Returns
+        =======
+        fname - path to the cached copy
+
+        """
+
+        source = os.path.join(self.atlas_directory, ATLAS_FILES[name])
+        cached = os.path.join(self.cache_directory, ATLAS_FILES[name])
+
+        try:
+            source_stat = os.stat(source)
+        except OSError:
+            # Share unreachable: fall back on an existing copy
+            if os.path.exists(cached):
+                return cached
+            raise FileNotFoundError('Atlas file ' + source + ' is not reachable and not cached')
+
+        if os.path.exists(cached):
+            cached_stat = os.stat(cached)
+            if cached_stat.st_size == source_stat.st_size and \
+               int(cached_stat.st_mtime) == int(source_stat.st_mtime):
+                return cached
+
+        if not os.path.exists(self.cache_directory):
+            os.makedirs(self.cache_directory)
+
+        print('Copying ' + source + ' to ' + self.cache_directory + '...')
+
+        temp_file = cached + '.part'
+        shutil.copy2(source, temp_file) # keeps mtime for the staleness check
+        os.replace(temp_file, cached)
+
+        return cached
+
+    def _load(self, name, loader):
+
+        if name not in self._loaded:
+            self._loaded[name] = loader(self.path(name))
+
+        return self._loaded[name]
+
+    @property
+    def labels(self):
+        """ CCF label volume (10 um, structure tree index + 1), memory-mapped """
+        return self._load('labels', lambda fname: np.load(fname, mmap_mode='r'))
+
+    @property
+    def structure_tree(self):
+        return self._load('structure_tree', pd.read_csv)
+
+    @property
+    def template_landmarks(self):
+        return self._load('template_landmarks', np.load)
+
+    @property
+    def template(self):
+        """ Template OPT volume, memory-mapped """
+        from volume_registration import memmap_volume
+        return self._load('template', memmap_volume)
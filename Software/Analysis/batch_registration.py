@@ -0,0 +1,174 @@
+import matplotlib
+matplotlib.use('Agg') # workers only save figures
+
+import numpy as np
+import pandas as pd
+import os
+import sys
+import argparse
+import time
+import traceback
+
+from multiprocessing import Pool
+
+from atlas_cache import AtlasCache, ATLAS_DIRECTORY, DEFAULT_CACHE_DIRECTORY
+from volume_registration import run_volume_registration, render_probe_figures
+
+
+_worker = {}
+
+def _init_worker(atlas_directory, cache_directory):
+
+    # One AtlasCache per worker, reused for every mouse it registers. The label
+    # volume is memory-mapped, so all workers share the same pages of the cached file.
+    _worker['atlas'] = AtlasCache(atlas_directory, cache_directory)
+
+
+def _register_mouse(args):
+
+    mouse, opt_directory, scan_type, use_field_cache = args
+
+    start_time = time.time()
+
+    figure_args = None
+
+    try:
+        # Figures are returned rather than drawn, so the worker can move on to the next mouse
+        figure_args = run_volume_registration(mouse, opt_directory, scan_type,
+                                              use_field_cache=use_field_cache, atlas=_worker['atlas'],
+                                              figures='deferred')
+        status, error = 'ok', ''
+    except Exception as e:
+        status, error = 'failed', repr(e)
+        traceback.print_exc()
+
+    return {'mouse': mouse,
+            'opt_directory': opt_directory,
+            'status': status,
+            'seconds': np.around(time.time() - start_time, 1),
+            'error': error}, figure_args
+
+
+def _render_figures(args):
+
+    try:
+        render_probe_figures(*args)
+    except Exception:
+        traceback.print_exc()
+
+
+def find_mice(base_directory):
+
+    """
+    Lists mouse directories under base_directory that are ready for registration
+
+    Parameters
+    ==========
+    base_directory - directory with one sub-directory per mouse ID
+
+    Returns
+    =======
+    mice - pd.DataFrame with columns mouse and opt_directory
+
+    """
+
+    mice = []
+
+    for mouse in sorted(os.listdir(base_directory)):
+        opt_directory = os.path.join(base_directory, mouse)
+        if os.path.exists(os.path.join(opt_directory, 'landmark_annotations.npy')) and \
+           os.path.exists(os.path.join(opt_directory, 'probe_annotations.csv')):
+            mice.append({'mouse': mouse, 'opt_directory': opt_directory})
+
+    return pd.DataFrame(mice, columns=['mouse', 'opt_directory'])
+
+
+def run_batch_registration(mice, report_file, scan_type='fluor', processes=4, use_field_cache=False,
+                           atlas_directory=ATLAS_DIRECTORY, cache_directory=DEFAULT_CACHE_DIRECTORY):
+
+    """
+    Registers many mice over a process pool
+
+    Figures are drawn by a second pool of the same size while registration
+    continues, and the report is written once both are done.
+
+    Parameters
+    ==========
+    mice - pd.DataFrame with columns mouse and opt_directory
+    report_file - CSV of per-mouse status, run time and error
+    scan_type - 'fluor' or 'trans'
+    processes - number of workers; each holds one 1 GB OPT volume at a time
+    use_field_cache - passed to run_volume_registration
+    atlas_directory, cache_directory - passed to AtlasCache
+
+    Returns
+    =======
+    report - pd.DataFrame
+
+    """
+
+    # Fill the cache once here, so workers never copy the same file concurrently
+    atlas = AtlasCache(atlas_directory, cache_directory)
+    for name in ['labels', 'structure_tree', 'template_landmarks']:
+        atlas.path(name)
+
+    rows = []
+    start_time = time.time()
+
+    tasks = [(str(mouse), opt_directory, scan_type, use_field_cache)
+             for mouse, opt_directory in zip(mice.mouse, mice.opt_directory)]
+
+    with Pool(processes, _init_worker, (atlas_directory, cache_directory)) as pool, \
+         Pool(processes) as figure_pool:
+
+        figure_results = []
+
+        for row, figure_args in pool.imap_unordered(_register_mouse, tasks):
+            print(row['mouse'] + ': ' + row['status'] + ' in ' + str(row['seconds']) + ' s')
+            rows.append(row)
+
+            if figure_args is not None:
+                figure_results.append(figure_pool.apply_async(_render_figures, (figure_args,)))
+
+        for result in figure_results:
+            result.wait()
+
+    report = pd.DataFrame(rows, columns=['mouse', 'opt_directory', 'status', 'seconds', 'error'])
+    report = report.sort_values('mouse').reset_index(drop=True)
+    report.to_csv(report_file, index=False)
+
+    failed = np.sum(report.status != 'ok')
+
+    print(str(len(report) - failed) + ' registered, ' + str(failed) + ' failed in ' +
+          str(np.around(time.time() - start_time, 1)) + ' s')
+    print('Report written to ' + report_file)
+
+    return report
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='Register many OPT volumes to the CCF')
+    parser.add_argument('mice', help='directory with one sub-directory per mouse, or CSV with columns mouse, opt_directory')
+    parser.add_argument('--report', default=None, help='report CSV (default = registration_report.csv next to mice)')
+    parser.add_argument('--scan-type', default='fluor', choices=['fluor', 'trans'])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--field-cache', action='store_true', help='bake and reuse deformation fields')
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.mice):
+        mice = find_mice(args.mice)
+        report_file = os.path.join(args.mice, 'registration_report.csv')
+    else:
+        mice = pd.read_csv(args.mice, dtype={'mouse': str})
+        report_file = os.path.join(os.path.dirname(os.path.abspath(args.mice)), 'registration_report.csv')
+
+    if args.report is not None:
+        report_file = args.report
+
+    run_batch_registration(mice, report_file, args.scan_type, args.processes,
+                           use_field_cache=args.field_cache)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
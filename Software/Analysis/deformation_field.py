@@ -0,0 +1,303 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from scipy.ndimage import map_coordinates
+
+
+class DeformationField:
+
+    """
+    Dense displacement field sampled on a regular grid
+
+    Points are transformed by trilinear interpolation of the displacement at
+    their position, so a query costs the same whatever the number of landmarks
+    behind the original transform. Implements the same point interface as
+    ThinPlateSplineTransform and can be passed to transform_probe_coordinates.
+
+    Parameters
+    ==========
+    origin - position of the first grid node (3,)
+    spacing - distance between grid nodes, in voxels
+    displacement - np.ndarray (nz x nx x ny x 3), transformed node minus node
+
+    """
+
+    def __init__(self, origin, spacing, displacement):
+
+        self.origin = np.asarray(origin, dtype='float64')
+        self.spacing = float(spacing)
+        self.displacement = displacement
+
+    @classmethod
+    def from_transform(cls, transform, volume_size=[1024, 1024, 1023], spacing=4):
+
+        """
+        Samples a transform on a grid covering the volume
+
+        Parameters
+        ==========
+        transform - object with a transform_points method (e.g. ThinPlateSplineTransform)
+        volume_size - list of x, y, z max dimensions, as in define_transform
+        spacing - grid spacing in voxels
+
+        Returns
+        =======
+        field - DeformationField
+
+        """
+
+        extent = np.array([volume_size[2], volume_size[0], volume_size[1]])
+        shape = np.ceil(extent / spacing).astype('int') + 1
+
+        axes = [np.arange(n) * spacing for n in shape]
+
+        displacement = np.empty(tuple(shape) + (3,), dtype='float32')
+
+        plane = np.stack(np.meshgrid(axes[1], axes[2], indexing='ij'), axis=-1).reshape(-1, 2)
+        nodes = np.empty((plane.shape[0], 3))
+        nodes[:, 1:] = plane
+
+        # One grid plane at a time keeps the point x landmark distance matrix small
+        for i, z in enumerate(axes[0]):
+            nodes[:, 0] = z
+            displacement[i] = (transform.transform_points(nodes) - nodes).reshape(shape[1], shape[2], 3)
+
+        return cls(np.zeros((3,)), spacing, displacement)
+
+    def transform_points(self, points):
+
+        """
+        Transforms an array of points
+
+        Points outside the grid take the displacement of the nearest edge node.
+
+        Parameters
+        ==========
+        points - np.ndarray (M x 3)
+
+        Returns
+        =======
+        transformed - np.ndarray (M x 3)
+
+        """
+
+        points = np.asarray(points, dtype='float64').reshape(-1, 3)
+
+        return points + self.displacement_at(points)
+
+    def displacement_at(self, points):
+
+        """
+        Trilinear interpolation of the displacement at an array of points (M x 3)
+        """
+
+        grid_coordinates = ((points - self.origin) / self.spacing).T
+
+        displacement = np.empty(points.shape)
+
+        for i in range(3):
+            displacement[:, i] = map_coordinates(self.displacement[..., i], grid_coordinates,
+                                                 order=1, mode='nearest')
+
+        return displacement
+
+    def inverse(self, iterations=50, tolerance=0.01, slab_size=16):
+
+        """
+        Inverse field on the same grid, by fixed-point iteration
+
+        The inverse maps each node y to the x with x + u(x) = y. Starting from
+        x = y - u(y), all nodes of a slab of grid planes are updated together
+        with x <- y - u(x) until every residual x + u(x) - y is below tolerance.
+        Convergence is only guaranteed where the displacement gradient is
+        smaller than 1 (the update is then a contraction); check the returned
+        residual.
+
+        Parameters
+        ==========
+        iterations - maximum number of iterations per slab
+        tolerance - largest accepted residual, in voxels
+        slab_size - grid planes iterated together
+
+        Returns
+        =======
+        field - DeformationField
+        residual - largest remaining residual |x + u(x) - y|, in voxels
+
+        """
+
+        shape = self.displacement.shape[:3]
+
+        inverse_displacement = np.empty(self.displacement.shape, dtype='float32')
+        max_residual = 0.
+
+        plane = np.stack(np.meshgrid(np.arange(shape[1]), np.arange(shape[2]), indexing='ij'), axis=-1)
+
+        for start in range(0, shape[0], slab_size):
+
+            stop = min(start + slab_size, shape[0])
+
+            nodes = np.empty((stop - start,) + shape[1:] + (3,))
+            nodes[..., 0] = np.arange(start, stop)[:, np.newaxis, np.newaxis]
+            nodes[..., 1:] = plane
+            nodes = (nodes * self.spacing + self.origin).reshape(-1, 3)
+
+            x = nodes - self.displacement[start:stop].reshape(-1, 3)
+
+            for iteration in range(iterations):
+                residual = x + self.displacement_at(x) - nodes
+                error = np.max(np.abs(residual))
+                if error < tolerance:
+                    break
+                x -= residual
+            else:
+                # Residual of the last update
+                error = np.max(np.abs(x + self.displacement_at(x) - nodes))
+
+            max_residual = max(max_residual, error)
+
+            inverse_displacement[start:stop] = (x - nodes).reshape(stop - start, shape[1], shape[2], 3)
+
+        return DeformationField(self.origin, self.spacing, inverse_displacement), max_residual
+
+    def TransformFloatPoint(self, point):
+
+        """
+        Single point interface of vtkThinPlateSplineTransform
+        """
+
+        return tuple(self.transform_points(point)[0])
+
+    def save(self, fname, metadata={}):
+
+        """
+        Writes the displacement to fname (.npy) and the grid to a .json file alongside
+
+        Both are written under temporary names and renamed, the .npy last, so an
+        interrupted save never leaves a .npy that load() cannot read.
+        """
+
+        info = dict(metadata)
+        info.update({'origin': self.origin.tolist(),
+                     'spacing': self.spacing,
+                     'shape': list(self.displacement.shape)})
+
+        json_file = os.path.splitext(fname)[0] + '.json'
+
+        with open(json_file + '.part', 'w') as f:
+            json.dump(info, f, indent=4)
+
+        with open(fname + '.part', 'wb') as f:
+            np.save(f, self.displacement)
+
+        os.replace(json_file + '.part', json_file)
+        os.replace(fname + '.part', fname)
+
+    @classmethod
+    def load(cls, fname, mmap_mode=None):
+
+        with open(os.path.splitext(fname)[0] + '.json', 'r') as f:
+            info = json.load(f)
+
+        return cls(info['origin'], info['spacing'], np.load(fname, mmap_mode=mmap_mode))
+
+
+def landmark_hash(landmark_files, **params):
+
+    """
+    Hash of the landmark file contents and the grid parameters, used as the cache key
+
+    Parameters
+    ==========
+    landmark_files - list of paths
+    params - any further settings the field depends on
+
+    Returns
+    =======
+    key - hex string
+
+    """
+
+    h = hashlib.sha1()
+
+    for fname in landmark_files:
+        with open(fname, 'rb') as f:
+            h.update(f.read())
+
+    h.update(json.dumps(params, sort_keys=True).encode())
+
+    return h.hexdigest()[:16]
+
+
+def deformation_field_path(cache_directory, landmark_files, volume_size=[1024, 1024, 1023], spacing=4,
+                           inverse=False):
+
+    """
+    Cache file of the deformation field for a set of landmark files and grid settings
+
+    The inverse field shares the key of the forward one, with an _inverse suffix.
+    """
+
+    key = landmark_hash(landmark_files, volume_size=list(volume_size), spacing=spacing)
+
+    return os.path.join(cache_directory, 'deformation_field_' + key + ('_inverse' if inverse else '') + '.npy')
+
+
+def cached_deformation_field(cache_directory, landmark_files, build_transform,
+                             volume_size=[1024, 1024, 1023], spacing=4, inverse=False, inverse_tolerance=0.01):
+
+    """
+    Loads the deformation field for a set of landmark files, baking and caching it
+    the first time
+
+    Parameters
+    ==========
+    cache_directory - where deformation_field_<key>.npy is stored
+    landmark_files - list of source and target landmark paths the transform is built from
+    build_transform - function returning the transform; only called on a cache miss
+    volume_size - list of x, y, z max dimensions
+    spacing - grid spacing in voxels
+    inverse - return the inverse of the field (see DeformationField.inverse),
+              computed from the cached forward field
+    inverse_tolerance - largest accepted inversion residual in voxels; a field
+                        that cannot be inverted to this accuracy raises ValueError
+                        and is not cached
+
+    Returns
+    =======
+    field - DeformationField
+
+    """
+
+    fname = deformation_field_path(cache_directory, landmark_files, volume_size, spacing, inverse)
+
+    if os.path.exists(fname):
+        print('Loading cached deformation field ' + fname)
+        return DeformationField.load(fname)
+
+    if inverse:
+        forward = cached_deformation_field(cache_directory, landmark_files, build_transform, volume_size, spacing)
+
+        print('Inverting deformation field...')
+
+        field, residual = forward.inverse(tolerance=inverse_tolerance)
+
+        if residual > inverse_tolerance:
+            raise ValueError('Deformation field inversion did not converge (largest residual ' +
+                             str(np.around(residual, 2)) + ' voxels); the warp may fold. Check the landmarks.')
+
+        field.save(fname, {'landmark_files': list(landmark_files), 'inverse': True, 'residual': float(residual)})
+
+        print('  Largest residual ' + str(np.around(residual, 3)) + ' voxels')
+
+        return field
+
+    print('Computing deformation field...')
+
+    field = DeformationField.from_transform(build_transform(), volume_size, spacing)
+    field.save(fname, {'landmark_files': list(landmark_files)})
+
+    return field
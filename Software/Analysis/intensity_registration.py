@@ -0,0 +1,405 @@
+import numpy as np
+import os
+import json
+import sys
+import argparse
+import time
+
+from scipy.ndimage import map_coordinates, gaussian_filter
+
+from deformation_field import DeformationField
+from volume_registration import memmap_volume
+from atlas_cache import AtlasCache
+
+
+FIELD_FILE = 'intensity_registration_field.npy'
+
+
+def downsample_volume(volume, factor):
+
+    """
+    Block-averages a volume by an integer factor, a few slices at a time
+
+    Voxel [i,j,k] of the result is the mean of the block whose center is
+    full-resolution position (factor-1)/2 + factor*[i,j,k].
+
+    Parameters
+    ==========
+    volume - 3-dimensional np.ndarray or np.memmap
+    factor - block size in voxels
+
+    Returns
+    =======
+    downsampled - float32 np.ndarray
+
+    """
+
+    shape = np.array(volume.shape) // factor
+
+    downsampled = np.empty(tuple(shape), dtype='float32')
+
+    for i in range(shape[0]):
+        slab = np.asarray(volume[i*factor:(i+1)*factor, :shape[1]*factor, :shape[2]*factor], dtype='float32')
+        downsampled[i] = slab.reshape(factor, shape[1], factor, shape[2], factor).mean(axis=(0,2,4))
+
+    return downsampled
+
+
+def normalize_intensity(image, percentiles=(1, 99)):
+
+    """
+    Maps the low and high intensity percentiles to 0 and 1
+
+    Unlike a z-score, this does not depend on how much of the field of view the
+    brain covers, which differs between the OPT volume and the template.
+    """
+
+    low, high = np.percentile(image, percentiles)
+
+    return (image - low) / max(high - low, 1e-6)
+
+
+def sample_image(image, points, factor):
+
+    """
+    Trilinear interpolation of a downsampled image at full-resolution positions
+
+    points - np.ndarray (3 x ...) in full-resolution voxels
+    """
+
+    origin = (factor - 1) / 2.
+
+    return map_coordinates(image, (points - origin) / factor, order=1, mode='nearest')
+
+
+def node_positions(shape, factor):
+
+    """
+    Full-resolution positions of the voxels of a downsampled image, as broadcastable axes
+    """
+
+    origin = (factor - 1) / 2.
+
+    return [(origin + factor * np.arange(n, dtype='float32')).reshape([-1 if a == axis else 1 for a in range(3)])
+            for axis, n in enumerate(shape)]
+
+
+def apply_affine(matrix, offset, center, axes):
+
+    """
+    Maps full-resolution positions x to matrix (x - center) + center + offset
+
+    axes - list of 3 broadcastable position arrays (see node_positions), or an
+           np.ndarray (3 x N)
+    """
+
+    return [sum(matrix[a,b] * (axes[b] - center[b]) for b in range(3)) + center[a] + offset[a]
+            for a in range(3)]
+
+
+def affine_registration(fixed, moving, factor, center, matrix=None, offset=None, iterations=30,
+                        num_samples=200000, seed=0):
+
+    """
+    Levenberg-Marquardt fit of an affine transform minimizing the sum of squared
+    intensity differences between fixed and transformed moving images
+
+    Parameters
+    ==========
+    fixed, moving - normalized downsampled volumes (same factor)
+    factor - downsampling factor of both images
+    center - center of the affine transform, in full-resolution voxels
+    matrix, offset - initial transform (default = identity)
+    iterations - maximum number of iterations
+    num_samples - voxels of the fixed image used for the metric
+
+    Returns
+    =======
+    matrix - np.ndarray (3 x 3)
+    offset - np.ndarray (3,)
+
+    Positions are full-resolution voxels: fixed voxel x corresponds to moving
+    position matrix (x - center) + center + offset.
+
+    """
+
+    matrix = np.eye(3) if matrix is None else np.array(matrix, dtype='float64')
+    offset = np.zeros((3,)) if offset is None else np.array(offset, dtype='float64')
+
+    rng = np.random.RandomState(seed)
+    indices = np.array([rng.randint(0, n, num_samples) for n in fixed.shape])
+
+    points = (factor - 1) / 2. + factor * indices.astype('float64')
+    fixed_values = fixed[indices[0], indices[1], indices[2]]
+
+    gradient = [g / factor for g in np.gradient(moving)]
+
+    centered = points - center[:,np.newaxis]
+
+    def residual(matrix, offset):
+        warped = np.array(apply_affine(matrix, offset, center, points))
+        return sample_image(moving, warped, factor) - fixed_values, warped
+
+    r, warped = residual(matrix, offset)
+    cost = np.mean(r**2)
+    damping = 1e-3
+
+    for iteration in range(iterations):
+
+        g = np.array([sample_image(gradient[a], warped, factor) for a in range(3)])
+
+        J = np.empty((num_samples, 12))
+        for a in range(3):
+            J[:, 3*a:3*a+3] = (g[a] * centered).T
+            J[:, 9+a] = g[a]
+
+        H = J.T @ J
+        b = J.T @ r
+
+        while damping < 1e6:
+
+            step = -np.linalg.solve(H + damping * np.diag(np.diag(H)), b)
+
+            new_matrix = matrix + step[:9].reshape(3,3)
+            new_offset = offset + step[9:]
+
+            new_r, new_warped = residual(new_matrix, new_offset)
+            new_cost = np.mean(new_r**2)
+
+            if new_cost < cost:
+                damping = max(damping / 10, 1e-7)
+                break
+
+            damping *= 10
+
+        else:
+            break # no step reduces the cost
+
+        converged = cost - new_cost < 1e-6 * cost
+
+        matrix, offset, r, warped, cost = new_matrix, new_offset, new_r, new_warped, new_cost
+
+        if converged:
+            break
+
+    return matrix, offset
+
+
+def demons_registration(fixed, moving, factor, center, matrix, offset, displacement=None, iterations=50,
+                        fluid_sigma=1.0, diffusion_sigma=1.5):
+
+    """
+    Symmetric-gradient demons on top of an affine transform
+
+    Parameters
+    ==========
+    fixed, moving - normalized downsampled volumes (same factor)
+    factor - downsampling factor of both images
+    center, matrix, offset - affine transform from affine_registration
+    displacement - initial displacement (3 x fixed.shape, full-resolution voxels)
+    iterations - number of demons iterations
+    fluid_sigma - smoothing of each update, in downsampled voxels
+    diffusion_sigma - smoothing of the accumulated displacement, in downsampled voxels
+
+    Returns
+    =======
+    displacement - float32 np.ndarray (3 x fixed.shape), added to the affine
+                   position of each fixed voxel, in full-resolution voxels
+
+    """
+
+    if displacement is None:
+        displacement = np.zeros((3,) + fixed.shape, dtype='float32')
+
+    affine_positions = apply_affine(matrix, offset, center, node_positions(fixed.shape, factor))
+
+    fixed_gradient = np.array(np.gradient(fixed))
+
+    for iteration in range(iterations):
+
+        warped_positions = np.empty((3,) + fixed.shape, dtype='float32')
+        for a in range(3):
+            warped_positions[a] = affine_positions[a] + displacement[a]
+
+        warped = sample_image(moving, warped_positions, factor)
+        del warped_positions
+
+        difference = warped - fixed
+
+        # Gradient in downsampled voxels, so each update moves at most half a voxel
+        gradient = (fixed_gradient + np.array(np.gradient(warped))) / 2.
+
+        denominator = np.sum(gradient**2, axis=0) + difference**2
+        denominator[denominator < 1e-9] = np.inf
+
+        for a in range(3):
+            update = gaussian_filter(-difference * gradient[a] / denominator, fluid_sigma)
+            displacement[a] = gaussian_filter(displacement[a] + factor * update, diffusion_sigma)
+
+    return displacement
+
+
+def upsample_displacement(displacement, factor, new_shape, new_factor):
+
+    """
+    Resamples a displacement from one pyramid level onto the grid of another
+    """
+
+    axes = node_positions(new_shape, new_factor)
+    points = np.array(np.broadcast_arrays(*axes))
+
+    return np.array([sample_image(displacement[a], points, factor) for a in range(3)], dtype='float32')
+
+
+def register_volumes(opt_volume, template_volume, levels=(8, 4), affine_iterations=(30, 15),
+                     demons_iterations=(50, 25), verbose=True):
+
+    """
+    Landmark-free registration of an OPT volume to the template
+
+    The OPT volume is the fixed image, so the result maps OPT positions to
+    template positions, the same direction as define_transform. Each pyramid
+    level refines the affine fit and then the demons displacement of the level
+    above it.
+
+    Parameters
+    ==========
+    opt_volume, template_volume - 3-dimensional np.ndarray or np.memmap, same shape
+    levels - downsampling factors, coarse to fine
+    affine_iterations - maximum affine iterations per level
+    demons_iterations - demons iterations per level
+
+    Returns
+    =======
+    field - DeformationField in landmark coordinates (z, x, y) with grid
+            spacing levels[-1], usable by transform_probe_coordinates
+
+    """
+
+    center = np.array(opt_volume.shape) / 2.
+
+    matrix, offset = None, None
+    displacement = None
+    previous_factor = None
+
+    for level, factor in enumerate(levels):
+
+        start_time = time.time()
+
+        fixed = normalize_intensity(downsample_volume(opt_volume, factor))
+        moving = normalize_intensity(downsample_volume(template_volume, factor))
+
+        matrix, offset = affine_registration(fixed, moving, factor, center, matrix, offset,
+                                             iterations=affine_iterations[level])
+
+        if displacement is not None:
+            displacement = upsample_displacement(displacement, previous_factor, fixed.shape, factor)
+
+        displacement = demons_registration(fixed, moving, factor, center, matrix, offset, displacement,
+                                           iterations=demons_iterations[level])
+
+        previous_factor = factor
+
+        if verbose:
+            print('  Level ' + str(factor) + ': ' + str(np.around(time.time() - start_time, 1)) + ' s')
+
+    axes = node_positions(fixed.shape, factor)
+    positions = apply_affine(matrix, offset, center, axes)
+
+    total = np.empty(fixed.shape + (3,), dtype='float32')
+    for a in range(3):
+        total[..., a] = positions[a] + displacement[a] - axes[a]
+
+    # Volume index order [a0, a1, a2] is (z, y, x) in landmark coordinates
+    origin = (factor - 1) / 2.
+
+    return DeformationField(np.array([origin] * 3), factor,
+                            np.ascontiguousarray(total.transpose(0, 2, 1, 3)[..., np.array([0, 2, 1])]))
+
+
+def field_metadata(mouse, opt_directory, scan_type='fluor'):
+
+    """
+    Identifies the OPT volume a field is computed from: mouse, scan type and
+    the size and modification time of the volume file
+    """
+
+    stat = os.stat(os.path.join(opt_directory, 'mouse' + mouse + '_' + scan_type + '.pvl.nc.001'))
+
+    return {'mouse': mouse,
+            'scan_type': scan_type,
+            'volume_bytes': stat.st_size,
+            'volume_mtime': int(stat.st_mtime)}
+
+
+def load_intensity_field(mouse, opt_directory, scan_type='fluor'):
+
+    """
+    Loads the saved intensity registration field of a mouse
+
+    Returns
+    =======
+    field - DeformationField, or None if there is no field or it was computed
+            from another scan type or an earlier version of the volume
+
+    """
+
+    field_file = os.path.join(opt_directory, FIELD_FILE)
+
+    if not os.path.exists(field_file):
+        return None
+
+    with open(os.path.splitext(field_file)[0] + '.json', 'r') as f:
+        info = json.load(f)
+
+    if any(info.get(key) != value for key, value in field_metadata(mouse, opt_directory, scan_type).items()):
+        print('  ' + FIELD_FILE + ' was computed from another volume, ignoring it')
+        return None
+
+    return DeformationField.load(field_file)
+
+
+def run_intensity_registration(mouse, opt_directory, scan_type='fluor', atlas=None, **kwargs):
+
+    """
+    Registers an OPT volume to the template without landmarks and saves the result
+    as intensity_registration_field.npy (+ .json) in opt_directory
+
+    The .json records the volume the field belongs to (see field_metadata).
+
+    Returns
+    =======
+    field - DeformationField
+
+    """
+
+    if atlas is None:
+        atlas = AtlasCache()
+
+    opt_volume = memmap_volume(os.path.join(opt_directory, 'mouse' + mouse + '_' + scan_type + '.pvl.nc.001'))
+
+    print('Registering mouse ' + mouse + ' to the template...')
+
+    start_time = time.time()
+
+    field = register_volumes(opt_volume, atlas.template, **kwargs)
+    field.save(os.path.join(opt_directory, FIELD_FILE), field_metadata(mouse, opt_directory, scan_type))
+
+    print('  Done in ' + str(np.around(time.time() - start_time, 1)) + ' s')
+
+    return field
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='Landmark-free registration of an OPT volume to the template')
+    parser.add_argument('mouse')
+    parser.add_argument('opt_directory')
+    parser.add_argument('--scan-type', default='fluor', choices=['fluor', 'trans'])
+    args = parser.parse_args(argv)
+
+    run_intensity_registration(args.mouse, args.opt_directory, args.scan_type)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
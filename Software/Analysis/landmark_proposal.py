@@ -0,0 +1,288 @@
+import numpy as np
+import os
+import sys
+import argparse
+import time
+
+from numpy.fft import rfftn, irfftn
+from scipy.fftpack import next_fast_len
+
+from intensity_registration import downsample_volume
+from volume_registration import memmap_volume
+from atlas_cache import AtlasCache
+
+
+def extract_patches(volume, centers, radius):
+
+    """
+    Cubes of side 2*radius+1 around each center, zero outside the volume
+
+    Parameters
+    ==========
+    volume - 3-dimensional np.ndarray or np.memmap
+    centers - np.ndarray (N x 3) of voxel indices
+    radius - half size of the cube in voxels
+
+    Returns
+    =======
+    patches - float32 np.ndarray (N x size x size x size)
+
+    """
+
+    size = 2 * radius + 1
+
+    patches = np.zeros((centers.shape[0], size, size, size), dtype='float32')
+
+    for i, center in enumerate(centers.astype('int')):
+
+        low = center - radius
+        high = center + radius + 1
+
+        src_low = np.maximum(low, 0)
+        src_high = np.minimum(high, volume.shape)
+
+        if np.any(src_high <= src_low):
+            continue
+
+        dst_low = src_low - low
+        dst_high = dst_low + (src_high - src_low)
+
+        patches[i, dst_low[0]:dst_high[0], dst_low[1]:dst_high[1], dst_low[2]:dst_high[2]] = \
+            volume[src_low[0]:src_high[0], src_low[1]:src_high[1], src_low[2]:src_high[2]]
+
+    return patches
+
+
+def window_sums(regions, size):
+
+    """
+    Sum of every size^3 window of each region, from a summed-volume table
+    """
+
+    table = regions.astype('float64')
+    for axis in (1, 2, 3):
+        table = np.cumsum(table, axis=axis)
+
+    table = np.pad(table, ((0,0), (1,0), (1,0), (1,0)), 'constant')
+
+    n = table.shape[1] - size
+
+    def corner(a, b, c):
+        return table[:, a:a+n, b:b+n, c:c+n]
+
+    s = size
+    return (corner(s,s,s) - corner(0,s,s) - corner(s,0,s) - corner(s,s,0)
+            + corner(0,0,s) + corner(0,s,0) + corner(s,0,0) - corner(0,0,0))
+
+
+def match_patches(patches, regions):
+
+    """
+    Normalized cross-correlation of each patch at every position inside its region, via FFT
+
+    Parameters
+    ==========
+    patches - np.ndarray (N x P x P x P)
+    regions - np.ndarray (N x S x S x S), S >= P
+
+    Returns
+    =======
+    ncc - np.ndarray (N x V x V x V), V = S - P + 1; position [i,j,k] places the
+          patch corner at region voxel [i,j,k]
+
+    """
+
+    P = patches.shape[1]
+    S = regions.shape[1]
+    V = S - P + 1
+
+    centered = patches - patches.mean(axis=(1,2,3), keepdims=True)
+    patch_norm = np.sqrt(np.sum(centered**2, axis=(1,2,3)))
+
+    shape = [next_fast_len(S)] * 3
+    axes = (1, 2, 3)
+
+    # Circular correlation of size >= S has no wrap-around at the V valid positions
+    correlation = irfftn(rfftn(regions, shape, axes=axes) * np.conj(rfftn(centered, shape, axes=axes)),
+                         shape, axes=axes)[:, :V, :V, :V]
+
+    n = P**3
+    sums = window_sums(regions, P)
+    variance = window_sums(regions**2, P) - sums**2 / n
+
+    denominator = patch_norm[:, np.newaxis, np.newaxis, np.newaxis] * np.sqrt(np.maximum(variance, 0))
+
+    ncc = np.zeros(correlation.shape)
+    valid = denominator > 1e-6 * n
+    ncc[valid] = correlation[valid] / denominator[valid]
+
+    return ncc
+
+
+def search_landmarks(volume, template_volume, template_centers, centers, patch_radius, search_radius,
+                     batch_size=64):
+
+    """
+    Moves each center to the position in volume that best matches the template
+    patch around the corresponding template center
+
+    Parameters
+    ==========
+    volume, template_volume - 3-dimensional arrays at the same scale
+    template_centers, centers - np.ndarray (N x 3) of voxel indices
+    patch_radius - half size of the template patch
+    search_radius - largest shift searched along each axis
+
+    Returns
+    =======
+    best - np.ndarray (N x 3) of voxel indices
+    score - np.ndarray (N,) peak NCC
+
+    """
+
+    best = np.empty(centers.shape)
+    score = np.empty((centers.shape[0],))
+
+    for start in range(0, centers.shape[0], batch_size):
+
+        batch = slice(start, start + batch_size)
+
+        patches = extract_patches(template_volume, template_centers[batch], patch_radius)
+        regions = extract_patches(volume, centers[batch], patch_radius + search_radius)
+
+        ncc = match_patches(patches, regions)
+
+        flat = ncc.reshape(ncc.shape[0], -1)
+        peak = np.argmax(flat, axis=1)
+
+        best[batch] = centers[batch] + np.column_stack(np.unravel_index(peak, ncc.shape[1:])) - search_radius
+        score[batch] = flat[np.arange(flat.shape[0]), peak]
+
+    return best, score
+
+
+def propose_landmarks(opt_volume, template_volume, template_landmarks, levels=(8, 4, 2, 1),
+                      patch_radius=8, search_radius=(6, 4, 3, 2), verbose=True):
+
+    """
+    Proposes the OPT position of every template landmark by coarse-to-fine
+    template matching
+
+    Each level searches around the estimate of the level above it, starting
+    from the template position itself (the volumes are roughly aligned by the
+    preprocessing app).
+
+    Parameters
+    ==========
+    opt_volume, template_volume - 3-dimensional np.ndarray or np.memmap
+    template_landmarks - np.ndarray (N x 3) as saved by registration_app, -1 = missing
+    levels - downsampling factors, coarse to fine
+    patch_radius - half size of the matched patch, in voxels of each level
+    search_radius - largest shift searched at each level, in voxels of that level
+
+    Returns
+    =======
+    proposals - np.ndarray (N x 3) in registration_app order, -1 where the template has no landmark
+    confidence - np.ndarray (N,) peak NCC at the finest level, -1 where missing
+
+    """
+
+    valid = template_landmarks[:,0] > -1
+
+    # registration_app stores (x, y, slice) = volume[slice, y, x]
+    template_positions = template_landmarks[valid][:, np.array([2,1,0])].astype('float64')
+    positions = np.copy(template_positions)
+
+    for level, factor in enumerate(levels):
+
+        start_time = time.time()
+
+        if factor > 1:
+            volume = downsample_volume(opt_volume, factor)
+            template = downsample_volume(template_volume, factor)
+        else:
+            volume, template = opt_volume, template_volume
+
+        origin = (factor - 1) / 2.
+
+        template_centers = np.around((template_positions - origin) / factor)
+
+        centers, score = search_landmarks(volume, template, template_centers,
+            np.around((positions - origin) / factor),
+            patch_radius, search_radius[level])
+
+        # Keep the sub-voxel offset of each landmark from its patch center
+        positions = (centers - template_centers) * factor + template_positions
+
+        if verbose:
+            print('  Level ' + str(factor) + ': median NCC ' + str(np.around(np.median(score), 3)) +
+                  ' in ' + str(np.around(time.time() - start_time, 1)) + ' s')
+
+    proposals = np.zeros(template_landmarks.shape) - 1
+    proposals[valid] = positions[:, np.array([2,1,0])]
+
+    confidence = np.zeros((template_landmarks.shape[0],)) - 1
+    confidence[valid] = score
+
+    return proposals, confidence
+
+
+def run_landmark_proposal(mouse, opt_directory, scan_type='fluor', atlas=None, overwrite=False,
+                          min_confidence=None, **kwargs):
+
+    """
+    Proposes landmarks for one mouse and pre-fills landmark_annotations.npy
+
+    An existing landmark_annotations.npy is only replaced if overwrite is True;
+    otherwise the proposals go to landmark_proposals.npy. Confidences are saved
+    to landmark_confidence.npy. Proposals below min_confidence are left unset
+    (-1) for the annotator to place.
+
+    Returns
+    =======
+    proposals, confidence - see propose_landmarks
+
+    """
+
+    if atlas is None:
+        atlas = AtlasCache()
+
+    opt_volume = memmap_volume(os.path.join(opt_directory, 'mouse' + mouse + '_' + scan_type + '.pvl.nc.001'))
+
+    print('Proposing landmarks for mouse ' + mouse + '...')
+
+    proposals, confidence = propose_landmarks(opt_volume, atlas.template, atlas.template_landmarks, **kwargs)
+
+    if min_confidence is not None:
+        proposals[confidence < min_confidence, :] = -1
+
+    output_file = os.path.join(opt_directory, 'landmark_annotations.npy')
+
+    if os.path.exists(output_file) and not overwrite:
+        output_file = os.path.join(opt_directory, 'landmark_proposals.npy')
+        print('  landmark_annotations.npy exists, not overwriting')
+
+    np.save(output_file, proposals)
+    np.save(os.path.join(opt_directory, 'landmark_confidence.npy'), confidence)
+
+    print('  ' + str(np.sum(proposals[:,0] > -1)) + ' landmarks written to ' + output_file)
+
+    return proposals, confidence
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='Propose OPT landmark positions by matching template patches')
+    parser.add_argument('mouse')
+    parser.add_argument('opt_directory')
+    parser.add_argument('--scan-type', default='fluor', choices=['fluor', 'trans'])
+    parser.add_argument('--overwrite', action='store_true', help='replace an existing landmark_annotations.npy')
+    parser.add_argument('--min-confidence', type=float, default=None, help='leave weaker matches unset')
+    args = parser.parse_args(argv)
+
+    run_landmark_proposal(args.mouse, args.opt_directory, args.scan_type,
+                          overwrite=args.overwrite, min_confidence=args.min_confidence)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -122,6 +122,11 @@ def save_volume(volume, mouse, data_directory, image_type):
 
     flattened.tofile(fname + '.001')
 
+    write_nc_header(fname)
+
+
+def write_nc_header(fname):
+
     nc_file_string = """<!DOCTYPE Drishti_Header>
     <PvlDotNcFileHeader>
       <rawfile></rawfile>
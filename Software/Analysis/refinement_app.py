@@ -19,6 +19,8 @@ import re
 
 import os, glob
 
+from volume_registration import read_ccf_coordinates
+
 # OFFSET_MAP = {'probeA': 120, 'probeB': 346, 'probeC': 572, 'probeD' : 798,
 #                      'probeE': 1024, 'probeF': 1250}
 # INDEX_MAP = {'probeA': 0, 'probeB': 1, 'probeC': 2, 'probeD' : 3,
@@ -349,7 +351,7 @@ class App(QWidget):
             self.fname, filt = QFileDialog.getOpenFileName(self, 
                 caption='Select ccf coordinates file', 
                 directory=self.current_directory,
-                filter='*.csv')
+                filter='CCF coordinates (*.csv *.parquet *.feather)')
         
         self.init_anchors = [False, False]
         
@@ -358,7 +360,7 @@ class App(QWidget):
 
         self.current_directory = os.path.dirname(fname)
         self.output_file = os.path.join(self.current_directory, 'final_ccf_coordinates.csv')
-        self.annotation_ccf_coordinates = os.path.join(self.current_directory, 'annotation_ccf_coordinates.csv')
+        self.annotation_ccf_coordinates = os.path.join(self.current_directory, 'annotation_ccf_coordinates')
         
         channel_vis_mod_files = glob.glob(os.path.join(self.current_directory, 'channel_visual_modulation*.npy'))
         session_dates = [cvm.split('_')[-1][:8] for cvm in channel_vis_mod_files]
@@ -370,20 +372,23 @@ class App(QWidget):
         print(selected_session)
         self.anchor_points_file = os.path.join(self.current_directory, selected_session + '_coordinate_anchor_points.npy')
         
-        if fname.split('.')[-1] == 'csv':
+        if fname.split('.')[-1] in ('csv', 'parquet', 'feather'):
 
             self.setWindowTitle(os.path.dirname(fname))
             if self.data_loaded:
                 self.df.loc[self.df['probe'].isin(self.probes), 'channels'] = 0
             else:
-                self.df = pd.read_csv(fname)
+                # volume_registration may have written CSV, Parquet or Feather
+                self.df = read_ccf_coordinates(fname)
+                self.df['probe'] = self.df['probe'].astype('str')
                 self.df['channels'] = 0
 
             #self.probes = [p for p in self.probes if p in self.df['probe'].unique()]
             #print(self.probes)
 
-            if os.path.exists(self.annotation_ccf_coordinates):    
-                self.df_ann = pd.read_csv(self.annotation_ccf_coordinates)
+            if any(os.path.exists(self.annotation_ccf_coordinates + ext) for ext in ('.csv', '.parquet', '.feather')):
+                self.df_ann = read_ccf_coordinates(self.annotation_ccf_coordinates)
+                self.df_ann['probe'] = self.df_ann['probe'].astype('str')
             else:
                 print('Missing annotation_ccf_coordinates.csv')
                 self.df_ann = []
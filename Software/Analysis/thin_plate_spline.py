@@ -0,0 +1,110 @@
+import numpy as np
+
+from scipy.spatial.distance import cdist
+from scipy.linalg import lu_factor, lu_solve
+
+
+class ThinPlateSplineTransform:
+
+    """
+    3D thin-plate spline warp between two sets of landmarks, in NumPy
+
+    Matches vtkThinPlateSplineTransform with SetBasisToR(): the basis function
+    is U(r) = r and the warp interpolates the landmarks exactly. The landmark
+    system is solved once; any number of points are then transformed together.
+
+    Parameters
+    ==========
+    source_landmarks - np.ndarray (N x 3)
+    target_landmarks - np.ndarray (N x 3)
+
+    """
+
+    def __init__(self, source_landmarks, target_landmarks):
+
+        self.source_landmarks = np.asarray(source_landmarks, dtype='float64')
+        self.target_landmarks = np.asarray(target_landmarks, dtype='float64')
+
+        N = self.source_landmarks.shape[0]
+
+        # [K P; P' 0] [W; A] = [target; 0], with K_ij = U(|p_i - p_j|) and P = [1 p]
+        L = np.zeros((N + 4, N + 4))
+        L[:N, :N] = cdist(self.source_landmarks, self.source_landmarks)
+        L[:N, N] = 1
+        L[:N, N+1:] = self.source_landmarks
+        L[N:, :N] = L[:N, N:].T
+
+        Y = np.zeros((N + 4, 3))
+        Y[:N, :] = self.target_landmarks
+
+        self.system_matrix = L
+
+        # Factorized once, for the coefficients and leave_one_out_errors
+        self._lu = lu_factor(L)
+        self.coefficients = lu_solve(self._lu, Y)
+
+    @property
+    def weights(self):
+        return self.coefficients[:-4]
+
+    @property
+    def affine(self):
+        return self.coefficients[-4:]
+
+    def leave_one_out_errors(self):
+
+        """
+        Error at each landmark of the spline fitted to all the other landmarks
+
+        Uses Rippa's identity e_i = c_i / (L^-1)_ii, so the N errors come from
+        the existing factorization instead of N refits.
+
+        Returns
+        =======
+        errors - np.ndarray (N x 3), target landmark minus its leave-one-out prediction
+
+        """
+
+        N = self.source_landmarks.shape[0]
+
+        inverse_diagonal = np.diag(lu_solve(self._lu, np.eye(N + 4)))[:N]
+
+        return self.weights / inverse_diagonal[:, np.newaxis]
+
+    def transform_points(self, points, chunk_size=65536):
+
+        """
+        Transforms an array of points
+
+        Parameters
+        ==========
+        points - np.ndarray (M x 3)
+        chunk_size - points per block, bounds memory for the M x N distance matrix
+
+        Returns
+        =======
+        transformed - np.ndarray (M x 3)
+
+        """
+
+        points = np.asarray(points, dtype='float64').reshape(-1, 3)
+
+        transformed = np.empty(points.shape)
+
+        for start in range(0, points.shape[0], chunk_size):
+
+            block = points[start:start + chunk_size]
+
+            transformed[start:start + chunk_size] = \
+                cdist(block, self.source_landmarks) @ self.weights + \
+                block @ self.affine[1:] + self.affine[0]
+
+        return transformed
+
+    def TransformFloatPoint(self, point):
+
+        """
+        Single point interface of vtkThinPlateSplineTransform
+        """
+
+        return tuple(self.transform_points(point)[0])
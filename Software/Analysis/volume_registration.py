@@ -1,13 +1,20 @@
-import vtk
-
 import numpy as np
 import pandas as pd
 import os
+import sys
+import argparse
+import multiprocessing
 
+import matplotlib
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D  
 
 from scipy.spatial.distance import euclidean
+from scipy.ndimage import map_coordinates
+
+from thin_plate_spline import ThinPlateSplineTransform
+from deformation_field import cached_deformation_field
+from atlas_cache import AtlasCache
 
 
 def loadVolume(fname, _dtype='u1'):
@@ -40,7 +47,36 @@ def loadVolume(fname, _dtype='u1'):
     
     return volume
 
-def define_transform(source_landmarks, target_landmarks, volume_size=[1024, 1024, 1023]):
+HEADER_SIZE = 13 # bytes before the voxel data in a Drishti .pvl.nc.001 file
+
+def memmap_volume(fname, mode='r'):
+
+    """
+    Opens a Drishti volume file without reading it into memory
+
+    Parameters
+    ==========
+    fname - filename (string)
+    mode - np.memmap mode
+
+    Returns
+    =======
+    volume - 3-dimensional np.memmap
+
+    """
+
+    header = np.fromfile(fname, 'u1', count=HEADER_SIZE).astype('int')
+
+    z_size = np.sum([header[1], header[2] << pow(2,3)])
+    x_size = np.sum([(val << pow(2,i+1)) for i, val in enumerate(header[8:4:-1])])
+    y_size = np.sum([(val << pow(2,i+1)) for i, val in enumerate(header[12:8:-1])])
+
+    fsize = (int(z_size), int(x_size), int(y_size))
+
+    return np.memmap(fname, dtype='u1', mode=mode, offset=HEADER_SIZE, shape=fsize)
+
+
+def define_transform(source_landmarks, target_landmarks, volume_size=[1024, 1024, 1023], use_vtk=False):
 
     """
     Defines a non-linear warp between a set of source and target landmarks
@@ -50,40 +86,203 @@ def define_transform(source_landmarks, target_landmarks, volume_size=[1024, 1024
     source_landmarks - np.ndarray (N x 3)
     target_landmarks - np.ndarray (N x 3)
     volume_size - list of x, y, z max dimensions
+    use_vtk - use vtkThinPlateSplineTransform instead of the NumPy implementation
 
     Returns
     =======
-    transform - vtkThinPlateSplineTransform
+    transform - ThinPlateSplineTransform (or vtkThinPlateSplineTransform if use_vtk)
 
     """
 
-    transform = vtk.vtkThinPlateSplineTransform()
+    corners = [[z,x,y] for x in [0,volume_size[0]]
+                       for y in [0,volume_size[1]]
+                       for z in [0,volume_size[2]]]
 
-    source_points = vtk.vtkPoints()
-    target_points = vtk.vtkPoints()
+    valid = (source_landmarks[:,0] > -1) & (target_landmarks[:,0] > -1)
 
-    for x in [0,volume_size[0]]:
-        for y in [0,volume_size[1]]:
-            for z in [0,volume_size[2]]:
-                source_points.InsertNextPoint([z,x,y])
-                target_points.InsertNextPoint([z,x,y])
+    source_points = np.vstack((corners, source_landmarks[valid,:]))
+    target_points = np.vstack((corners, target_landmarks[valid,:]))
 
-    for i in range(source_landmarks.shape[0]):
-        if source_landmarks[i,0] > -1 and target_landmarks[i,0] > -1:
-            source_points.InsertNextPoint(source_landmarks[i,:])
-        
-    for i in range(target_landmarks.shape[0]):
-        if source_landmarks[i,0] > -1 and target_landmarks[i,0] > -1:
-            target_points.InsertNextPoint(target_landmarks[i,:])
+    if not use_vtk:
+        return ThinPlateSplineTransform(source_points, target_points)
+
+    import vtk
+
+    transform = vtk.vtkThinPlateSplineTransform()
+
+    vtk_source_points = vtk.vtkPoints()
+    vtk_target_points = vtk.vtkPoints()
+
+    for i in range(source_points.shape[0]):
+        vtk_source_points.InsertNextPoint(source_points[i,:])
+        vtk_target_points.InsertNextPoint(target_points[i,:])
 
     transform.SetBasisToR() # for 3D transform
-    transform.SetSourceLandmarks(source_points)
-    transform.SetTargetLandmarks(target_points)
+    transform.SetSourceLandmarks(vtk_source_points)
+    transform.SetTargetLandmarks(vtk_target_points)
     transform.Update()
 
     return transform
 
 
+def transform_points(transform, points):
+
+    """
+    Applies a transform to an array of points
+
+    Parameters
+    ==========
+    transform - ThinPlateSplineTransform or vtkThinPlateSplineTransform
+    points - np.ndarray (N x 3)
+
+    Returns
+    =======
+    transformed - np.ndarray (N x 3)
+
+    """
+
+    if hasattr(transform, 'transform_points'):
+        return transform.transform_points(points)
+
+    return np.array([transform.TransformFloatPoint(point) for point in points])
+
+
+# Template volume to CCF voxel mapping used by transform_probe_coordinates
+CCF_ORIGIN = np.array([-35, 42, 217],dtype='int')
+CCF_SCALING = np.array([1160/1023,  1140/940, 800/590])
+
+
+def to_ccf_coordinates(transformed_points, origin, scaling):
+
+    """
+    Converts points in template volume coordinates (z, x, y) to CCF voxel
+    coordinates (A/P, D/V, M/L) at 10 um
+
+    """
+
+    ccf_coordinates = (np.column_stack((1023 - transformed_points[:,0],
+                                        transformed_points[:,1],
+                                        transformed_points[:,2])) - origin) * scaling
+
+    return ccf_coordinates[:,np.array([0,2,1])]
+
+
+def landmark_loo_errors(source_landmarks, target_landmarks, outlier_threshold=3.0):
+
+    """
+    Leave-one-out error of each landmark of the thin-plate spline warp
+
+    The error of a landmark is the distance between its target position and the
+    one predicted by the warp through all the other landmarks (the volume
+    corners always stay in). Landmarks further than outlier_threshold scaled
+    MADs above the median error are flagged as outliers.
+
+    Parameters
+    ==========
+    source_landmarks - np.ndarray (N x 3)
+    target_landmarks - np.ndarray (N x 3)
+    outlier_threshold - number of MADs above the median
+
+    Returns
+    =======
+    report - pd.DataFrame with one row per valid landmark: its row in
+             landmark_annotations.npy, error components in template voxels
+             (registration_app x, y, slice), error length and outlier flag
+
+    """
+
+    transform = define_transform(source_landmarks, target_landmarks)
+
+    valid = np.where((source_landmarks[:,0] > -1) & (target_landmarks[:,0] > -1))[0]
+
+    num_corners = transform.source_landmarks.shape[0] - valid.size
+
+    errors = transform.leave_one_out_errors()[num_corners:]
+    distance = np.linalg.norm(errors, axis=1)
+
+    median = np.median(distance)
+    mad = 1.4826 * np.median(np.abs(distance - median)) # scaled to a standard deviation
+
+    report = pd.DataFrame({'landmark': valid,
+                           'error_x': errors[:,1],
+                           'error_y': errors[:,2],
+                           'error_slice': errors[:,0],
+                           'error': distance,
+                           'outlier': distance > median + outlier_threshold * mad},
+                          columns=['landmark', 'error_x', 'error_y', 'error_slice', 'error', 'outlier'])
+
+    return report
+
+
+def from_ccf_coordinates(ccf_coordinates, origin=CCF_ORIGIN, scaling=CCF_SCALING):
+
+    """
+    Converts CCF voxel coordinates (A/P, D/V, M/L) at 10 um to template volume
+    coordinates (z, x, y); the inverse of to_ccf_coordinates
+
+    """
+
+    points = ccf_coordinates[:,np.array([0,2,1])] / scaling + origin
+
+    return np.column_stack((1023 - points[:,0], points[:,1], points[:,2]))
+
+
+def load_inverse_transform(opt_directory, atlas=None, spacing=4):
+
+    """
+    Template-to-OPT warp for one mouse, as a cached inverse deformation field
+
+    The forward field is shared with run_volume_registration(use_field_cache=True),
+    and both are computed on the first call only.
+
+    Parameters
+    ==========
+    opt_directory - directory with landmark_annotations.npy, also used as the cache
+    atlas - AtlasCache (default = AtlasCache())
+    spacing - grid spacing in voxels
+
+    Returns
+    =======
+    inverse_transform - DeformationField mapping template (z, x, y) to OPT (z, x, y)
+
+    """
+
+    if atlas is None:
+        atlas = AtlasCache()
+
+    source_landmark_file = os.path.join(opt_directory, 'landmark_annotations.npy')
+    target_landmark_file = atlas.path('template_landmarks')
+
+    source_landmarks = np.load(source_landmark_file)[:,np.array([2,0,1])]
+    target_landmarks = np.load(target_landmark_file)[:,np.array([2,0,1])]
+
+    return cached_deformation_field(opt_directory, [source_landmark_file, target_landmark_file],
+        lambda: define_transform(source_landmarks, target_landmarks), spacing=spacing, inverse=True)
+
+
+def ccf_to_opt(inverse_transform, ccf_coordinates):
+
+    """
+    Finds where CCF positions are in an OPT volume
+
+    Parameters
+    ==========
+    inverse_transform - DeformationField from load_inverse_transform
+    ccf_coordinates - np.ndarray (N x 3) in CCF voxels (A/P, D/V, M/L) at 10 um;
+                      multiply the mm values of the coordinate tables by 100
+
+    Returns
+    =======
+    volume_points - np.ndarray (N x 3) of (fractional) indices into the OPT volume
+
+    """
+
+    template_points = from_ccf_coordinates(np.asarray(ccf_coordinates, dtype='float64').reshape(-1, 3))
+
+    opt_points = transform_points(inverse_transform, template_points)
+
+    return opt_points[:,np.array([0,2,1])]
+
 
 def plot_transform(source_landmarks, target_landmarks):
 
@@ -126,13 +325,84 @@ def plot_transform(source_landmarks, target_landmarks):
     plt.ylabel('LR')
     ax.set_zlabel('DV')
 
-    plt.show()
-
     return fig
 
 
+def lookup_structure_ids(labels, ccf_coordinates):
+
+    """
+    Looks up the structure index of each point in the label volume
+
+    Parameters
+    ==========
+    labels - 3-dimensional np.ndarray of structure indices (1-based, 0 = outside the brain)
+    ccf_coordinates - np.ndarray (N x 3) in CCF voxels
+
+    Returns
+    =======
+    structure_ids - np.ndarray (N,) of structure tree indices, -1 outside the atlas
+
+    """
+
+    indices = np.trunc(ccf_coordinates).astype('int')
+
+    inside = np.all((indices >= 0) & (indices < np.array(labels.shape)), axis=1)
+
+    structure_ids = np.full((ccf_coordinates.shape[0],), -1, dtype='int')
+    structure_ids[inside] = labels[indices[inside,0], indices[inside,1], indices[inside,2]].astype('int') - 1
+
+    return structure_ids
+
+
+def sample_intensity_profiles(volume, points, half_width=20, order=0):
+
+    """
+    Samples the volume along a diagonal profile through each point
+
+    Profile sample k of point p is volume[p0, p1 + k, p2 + k], for k in
+    [-half_width, half_width). Samples outside the volume are 0.
+
+    Parameters
+    ==========
+    volume - 3-dimensional np.ndarray
+    points - np.ndarray (N x 3) in volume index order
+    half_width - number of samples on each side of the point
+    order - 0 truncates coordinates to voxel indices; 1 or higher interpolates
+            with a spline of that order
+
+    Returns
+    =======
+    intensity_values - np.ndarray (N x 2*half_width)
+
+    """
+
+    offsets = np.arange(-half_width, half_width)
+
+    coords = np.empty((3, points.shape[0], offsets.size))
+    coords[0] = points[:,0,np.newaxis]
+    coords[1] = points[:,1,np.newaxis] + offsets
+    coords[2] = points[:,2,np.newaxis] + offsets
+
+    if order > 0:
+        return map_coordinates(volume, coords.reshape(3,-1), order=order, 
+                               cval=0).reshape(points.shape[0], offsets.size)
+
+    indices = np.trunc(coords).astype('int')
+
+    inside = np.all((indices >= 0) & (indices < np.array(volume.shape)[:,np.newaxis,np.newaxis]), axis=0)
+
+    intensity_values = np.zeros(inside.shape)
+    intensity_values[inside] = volume[indices[0][inside], indices[1][inside], indices[2][inside]]
+
+    return intensity_values
+
+
+CCF_COLUMNS = ['probe','structure_id', 'A/P','D/V','M/L']
+
+
 def transform_probe_coordinates(transform, probe_annotations, labels, volume, 
-    structure_tree, save_path=None, save_figures=False):
+    structure_tree, save_path=None, save_figures=False, profile_half_width=20, profile_order=0,
+    figure_data=None):
 
     """
     Creates a figure showing the translation between
@@ -143,6 +413,10 @@ def transform_probe_coordinates(transform, probe_annotations, labels, volume,
     transform - vtkThinPlateSplineTransform
     probe_annotations - pd.DataFrame with original coordinates
     plot - boolean (generates plots if True)
+    profile_half_width - intensity profile samples on each side of the track
+    profile_order - interpolation order of the profiles (see sample_intensity_profiles)
+    figure_data - list to append the per-probe arrays needed by render_probe_figures to,
+                  so the figures can be drawn later or in another process
 
     Returns
     =======
@@ -150,32 +424,25 @@ def transform_probe_coordinates(transform, probe_annotations, labels, volume,
 
     """
 
-    if save_figures:
-        save_prefix = os.path.basename(save_path) + '_'
-        fig1 = plt.figure(147142)
-        plt.clf()
-        ax1 = fig1.add_subplot(111, projection='3d')
-        
-        fig2 = plt.figure(147143)
-        plt.clf()
-
-    colors = ('red', 'orange', 'brown', 'green', 'blue', 'purple',
-              'red', 'orange', 'brown', 'green', 'blue', 'purple')
+    if save_figures and figure_data is None:
+        figure_data = []
 
     probes = ('Probe A1', 'Probe B1', 'Probe C1', 'Probe D1', 'Probe E1', 'Probe F1',
               'Probe A2', 'Probe B2', 'Probe C2', 'Probe D2', 'Probe E2', 'Probe F2')
-    
-    probes_short = ('A1', 'B1', 'C1', 'D1', 'E1', 'F1',
-                    'A2', 'B2', 'C2', 'D2', 'E2', 'F2')
 
-    origin = np.array([-35, 42, 217],dtype='int')
-    scaling = np.array([1160/1023,  1140/940, 800/590])
+    origin = CCF_ORIGIN
+    scaling = CCF_SCALING
 
-    df_columns = ['probe','structure_id', 'A/P','D/V','M/L']
+    track_points = np.mgrid[-200:200:0.7]
 
-    df = pd.DataFrame(columns = df_columns)
-    
-    df_a = pd.DataFrame(columns = df_columns)
+    # Row counts are known up front, so each output column is allocated once
+    probe_counts = [np.sum(probe_annotations.probe_name == probe) for probe in probes]
+
+    columns = allocate_ccf_columns(np.count_nonzero(probe_counts) * track_points.size)
+    columns_a = allocate_ccf_columns(np.sum(probe_counts))
+
+    row = 0
+    row_a = 0
 
     for probe_idx, probe in enumerate(probes):
         
@@ -194,140 +461,295 @@ def transform_probe_coordinates(transform, probe_annotations, labels, volume,
             m2 = np.max(D[:,1]) * 2
             uu,dd,vv = np.linalg.svd(D)
 
-            linepts = vv[0] * np.mgrid[-200:200:0.7][:,np.newaxis]
+            linepts = vv[0] * track_points[:,np.newaxis]
             linepts += datamean
             
             if linepts[-1,1] - linepts[0,1] < 0:
                 linepts = np.flipud(linepts)
-             
-            if save_figures:
-                ax1.scatter(z,x,-y,c=colors[probe_idx], s=5, alpha=0.95)
-                ax1.plot3D(linepts[:,0],linepts[:,2],-linepts[:,1],color=colors[probe_idx], alpha=0.5)
-                plt.xlabel('A/P')
-                plt.ylabel('M/L')
-
-            intensity_values = np.zeros((linepts.shape[0],40))
-            structure_ids = np.zeros((linepts.shape[0],))
-            ccf_coordinates = np.zeros((linepts.shape[0],3))
+
+            intensity_values = sample_intensity_profiles(volume, linepts, 
+                profile_half_width, profile_order)
             
+            ccf_coordinates = to_ccf_coordinates(
+                transform_points(transform, linepts[:,np.array([0,2,1])]), origin, scaling)
             
-            for j in range(linepts.shape[0]):
-                
-                z2,x2,y2 = transform.TransformFloatPoint(linepts[j,np.array([0,2,1])])
-                
-                ccf_coordinate = (np.array([1023-z2,x2,y2]) - origin) * scaling
-                ccf_coordinate = ccf_coordinate[np.array([0,2,1])]
-                
-                ccf_coordinate_mm = ccf_coordinate * 0.01
-                
-                ccf_coordinates[j,:] = ccf_coordinate_mm
-                
-
-                try:
-                    structure_ids[j] = int(labels[int(ccf_coordinate[0]),int(ccf_coordinate[1]),int(ccf_coordinate[2])]) - 1
-                except IndexError:
-                    structure_ids[j] = -1
-                
-                for k in range(-20,20):
-                    try:
-                        intensity_values[j,k+20] = (volume[int(linepts[j,0]),int(linepts[j,1]+k),int(linepts[j,2]+k)])
-                    except IndexError:
-                        pass
-                          
-            data = {'probe': [probes[probe_idx]]*linepts.shape[0], 
-                    'structure_id': structure_ids.astype('int'), 
-                    'A/P' : np.around(ccf_coordinates[:,0],3), 
-                    'D/V' : np.around(ccf_coordinates[:,1],3), 
-                    'M/L' : np.around(ccf_coordinates[:,2],3) 
-                    }
+            structure_ids = lookup_structure_ids(labels, ccf_coordinates)
             
-            probe_df = pd.DataFrame(data)
-        
-            df = pd.concat((df, probe_df) ,ignore_index=True)
+            row = fill_ccf_columns(columns, row, probe, structure_ids, ccf_coordinates * 0.01)
             
             #get the ccf coordinates of transformed annotation points
-            intensity_values_a = np.zeros((data_a.shape[0],40))
-            structure_ids_a = np.zeros((data_a.shape[0],))
-            ccf_coordinates_a = np.zeros((data_a.shape[0],3))
+            intensity_values_a = sample_intensity_profiles(volume, data_a, 
+                profile_half_width, profile_order)
             
-            for j in range(data_a.shape[0]):
-                
-                za,xa,ya = transform.TransformFloatPoint(data_a[j,np.array([0,2,1])])
-                
-                ccf_coordinate_a = (np.array([1023-za,xa,ya]) - origin) * scaling
-                ccf_coordinate_a = ccf_coordinate_a[np.array([0,2,1])]
-                
-                ccf_coordinate_a_mm = ccf_coordinate_a * 0.01
-                
-                ccf_coordinates_a[j,:] = ccf_coordinate_a_mm
-                
-                try:
-                    structure_ids_a[j] = int(labels[int(ccf_coordinate_a[0]),int(ccf_coordinate_a[1]),int(ccf_coordinate_a[2])]) - 1
-                except IndexError:
-                    structure_ids_a[j] = -1
-                
-                for k in range(-20,20):
-                    try:
-                        intensity_values_a[j,k+20] = (volume[int(data_a[j,0]),int(data_a[j,1]+k),int(data_a[j,2]+k)])
-                    except IndexError:
-                        pass
+            ccf_coordinates_a = to_ccf_coordinates(
+                transform_points(transform, data_a[:,np.array([0,2,1])]), origin, scaling)
             
-            data_a = {
-                'probe': [probes[probe_idx]]*data_a.shape[0], 
-                'structure_id': structure_ids_a.astype('int'), 
-                'A/P' : np.around(ccf_coordinates_a[:,0],3), 
-                'D/V' : np.around(ccf_coordinates_a[:,1],3), 
-                'M/L' : np.around(ccf_coordinates_a[:,2],3)
-                }
+            structure_ids_a = lookup_structure_ids(labels, ccf_coordinates_a)
             
-            probe_df_a = pd.DataFrame(data_a)
-        
-            df_a = pd.concat((df_a, probe_df_a) ,ignore_index=True)
+            row_a = fill_ccf_columns(columns_a, row_a, probe, structure_ids_a, ccf_coordinates_a * 0.01)
             
-            if save_figures:
-                plt.figure(147143)
-                plt.subplot(1,24,probe_idx*2+1)
-                plt.imshow(intensity_values, cmap='gray',aspect='auto')
-                plt.plot([20,20],[0,j],'-r')
-                plt.axis('off')
-                plt.title(probes_short[probe_idx])
-
-                fig = plt.figure(frameon=False)
-                fig.set_size_inches(1,8)
-                
-                ax = plt.Axes(fig, [0., 0., 1., 1.])
-                ax.set_axis_off()
-                fig.add_axes(ax)
-                
-                ax.imshow(intensity_values, cmap='gray',aspect='auto')
-
-                fig.savefig(os.path.join(save_path, save_prefix + probe + '.png'), dpi=300)    
-                
-                plt.close(fig)
-                    
-                borders = np.where(np.abs(np.diff(structure_ids)) > 0)[0]
-                jumps = np.concatenate((np.array([5]),np.diff(borders)))
-                borders = borders[jumps > 6]
-                
-                for border in borders[::1]:
-                    plt.plot([0,40],[border,border],'-',color='white',alpha=0.5)
-                    
-                plt.subplot(1,24,probe_idx*2+2)
-                for border in borders[::1]:
-                    plt.text(0,j-border-1,structure_tree[structure_tree.index == structure_ids[border-1]]['acronym'].iloc[0])
-                    
-                plt.text(0,0,structure_tree[structure_tree.index == structure_ids[-1]]['acronym'].iloc[0])
-                plt.ylim([0,j+1])
-                plt.axis('off')
+            if figure_data is not None:
+                figure_data.append({'probe': probe,
+                                    'probe_idx': probe_idx,
+                                    'annotations': data_a,
+                                    'linepts': linepts,
+                                    'intensity_values': intensity_values,
+                                    'structure_ids': structure_ids})
 
     if save_figures:
-        fig1.savefig(os.path.join(save_path, save_prefix + 'probe_line_fits.png'), dpi=300)
-        fig2.savefig(os.path.join(save_path, save_prefix + 'probe_tracks.png'), dpi=300)
+        render_probe_figures(figure_data, structure_tree, save_path, profile_half_width)
+
+    df = pd.DataFrame(columns, columns=CCF_COLUMNS)
+    df_a = pd.DataFrame(columns_a, columns=CCF_COLUMNS)
 
     return df, df_a
 
 
-def run_volume_registration(mouse, opt_directory, scan_type='fluor'):
+def render_probe_figures(figure_data, structure_tree, save_path, profile_half_width=20, landmarks=None):
+
+    """
+    Saves the probe track figures from the arrays collected by transform_probe_coordinates
+
+    Parameters
+    ==========
+    figure_data - list of per-probe dicts from transform_probe_coordinates
+    structure_tree - pd.DataFrame with structure acronyms
+    save_path - output directory; its name prefixes the figure files
+    profile_half_width - as passed to transform_probe_coordinates
+    landmarks - optional (source_landmarks, target_landmarks), also saves transform_plot.png
+
+    """
+
+    if landmarks is not None:
+        fig = plot_transform(*landmarks)
+        fig.savefig(os.path.join(save_path, 'transform_plot.png'))
+
+    save_prefix = os.path.basename(save_path) + '_'
+
+    colors = ('red', 'orange', 'brown', 'green', 'blue', 'purple',
+              'red', 'orange', 'brown', 'green', 'blue', 'purple')
+
+    probes_short = ('A1', 'B1', 'C1', 'D1', 'E1', 'F1',
+                    'A2', 'B2', 'C2', 'D2', 'E2', 'F2')
+
+    fig1 = plt.figure(147142)
+    plt.clf()
+    ax1 = fig1.add_subplot(111, projection='3d')
+    ax1.set_xlabel('A/P')
+    ax1.set_ylabel('M/L')
+    
+    fig2 = plt.figure(147143)
+    plt.clf()
+
+    for probe_data in figure_data:
+
+        probe = probe_data['probe']
+        probe_idx = probe_data['probe_idx']
+        annotations = probe_data['annotations']
+        linepts = probe_data['linepts']
+        intensity_values = probe_data['intensity_values']
+        structure_ids = probe_data['structure_ids']
+
+        ax1.scatter(annotations[:,0],annotations[:,2],-annotations[:,1],c=colors[probe_idx], s=5, alpha=0.95)
+        ax1.plot3D(linepts[:,0],linepts[:,2],-linepts[:,1],color=colors[probe_idx], alpha=0.5)
+
+        j = linepts.shape[0] - 1 # last point along the track
+        
+        plt.figure(147143)
+        plt.subplot(1,24,probe_idx*2+1)
+        plt.imshow(intensity_values, cmap='gray',aspect='auto')
+        plt.plot([profile_half_width,profile_half_width],[0,j],'-r')
+        plt.axis('off')
+        plt.title(probes_short[probe_idx])
+
+        fig = plt.figure(frameon=False)
+        fig.set_size_inches(1,8)
+        
+        ax = plt.Axes(fig, [0., 0., 1., 1.])
+        ax.set_axis_off()
+        fig.add_axes(ax)
+        
+        ax.imshow(intensity_values, cmap='gray',aspect='auto')
+
+        fig.savefig(os.path.join(save_path, save_prefix + probe + '.png'), dpi=300)    
+        
+        plt.close(fig)
+            
+        borders = np.where(np.abs(np.diff(structure_ids)) > 0)[0]
+        jumps = np.concatenate((np.array([5]),np.diff(borders)))
+        borders = borders[jumps > 6]
+        
+        plt.figure(147143)
+        for border in borders[::1]:
+            plt.plot([0,2*profile_half_width],[border,border],'-',color='white',alpha=0.5)
+            
+        plt.subplot(1,24,probe_idx*2+2)
+        for border in borders[::1]:
+            plt.text(0,j-border-1,structure_tree[structure_tree.index == structure_ids[border-1]]['acronym'].iloc[0])
+            
+        plt.text(0,0,structure_tree[structure_tree.index == structure_ids[-1]]['acronym'].iloc[0])
+        plt.ylim([0,j+1])
+        plt.axis('off')
+
+    fig1.savefig(os.path.join(save_path, save_prefix + 'probe_line_fits.png'), dpi=300)
+    fig2.savefig(os.path.join(save_path, save_prefix + 'probe_tracks.png'), dpi=300)
+
+    plt.close(fig1)
+    plt.close(fig2)
+
+
+def _render_figures_agg(*args):
+
+    plt.switch_backend('Agg')
+    render_probe_figures(*args)
+
+
+def start_figure_process(*args):
+
+    """
+    Runs render_probe_figures(*args) in a new process with the Agg backend
+
+    The process is spawned rather than forked, so it does not inherit the
+    caller's figures or GUI backend. As with any spawned process, scripts
+    that call this must do so under if __name__ == "__main__".
+
+    Returns
+    =======
+    process - multiprocessing.Process, already started; join() waits for the figures
+
+    """
+
+    process = multiprocessing.get_context('spawn').Process(target=_render_figures_agg, args=args)
+    process.start()
+
+    return process
+
+
+def allocate_ccf_columns(num_rows):
+
+    """
+    Empty columns of a CCF coordinate table
+    """
+
+    return {'probe': np.empty((num_rows,), dtype='object'),
+            'structure_id': np.empty((num_rows,), dtype='int'),
+            'A/P': np.empty((num_rows,)),
+            'D/V': np.empty((num_rows,)),
+            'M/L': np.empty((num_rows,))}
+
+
+def fill_ccf_columns(columns, start, probe, structure_ids, ccf_coordinates):
+
+    """
+    Writes one probe's rows into the columns from allocate_ccf_columns
+
+    Returns
+    =======
+    stop - first row after the ones written
+
+    """
+
+    stop = start + len(structure_ids)
+
+    columns['probe'][start:stop] = probe
+    columns['structure_id'][start:stop] = structure_ids
+
+    for i, axis in enumerate(['A/P', 'D/V', 'M/L']):
+        columns[axis][start:stop] = np.around(ccf_coordinates[:,i], 3)
+
+    return stop
+
+
+def write_ccf_coordinates(df, fname, output_formats=('csv',)):
+
+    """
+    Writes a CCF coordinate table in one or more formats
+
+    Parameters
+    ==========
+    df - pd.DataFrame from transform_probe_coordinates
+    fname - output path without extension
+    output_formats - any of 'csv', 'parquet', 'feather'; the binary formats
+                     need pyarrow and store probe as a categorical column
+
+    """
+
+    for output_format in output_formats:
+
+        if output_format == 'csv':
+            df.to_csv(fname + '.csv')
+            continue
+
+        typed = df.astype({'probe': 'category', 'structure_id': 'int32'})
+
+        if output_format == 'parquet':
+            typed.to_parquet(fname + '.parquet')
+        elif output_format == 'feather':
+            typed.reset_index(drop=True).to_feather(fname + '.feather')
+        else:
+            raise ValueError('Unknown output format ' + output_format)
+
+
+def read_ccf_coordinates(fname):
+
+    """
+    Reads a CCF coordinate table written by write_ccf_coordinates
+
+    A path ending in .csv, .parquet or .feather is read as that format. For a path
+    without extension, the newest of the CSV, Parquet and Feather files is used, so
+    a table left over from an earlier export does not hide a later one.
+
+    Parameters
+    ==========
+    fname - path with or without extension, e.g. <opt_directory>/initial_ccf_coordinates
+
+    Returns
+    =======
+    df - pd.DataFrame
+
+    """
+
+    readers = {'.csv': lambda f: pd.read_csv(f, index_col=0),
+               '.parquet': pd.read_parquet,
+               '.feather': pd.read_feather}
+
+    ext = os.path.splitext(fname)[1]
+
+    if ext in readers:
+        return readers[ext](fname)
+
+    candidates = [fname + e for e in readers if os.path.exists(fname + e)]
+
+    if len(candidates) == 0:
+        raise FileNotFoundError('No CCF coordinate table found for ' + fname)
+
+    newest = max(candidates, key=os.path.getmtime)
+
+    return readers[os.path.splitext(newest)[1]](newest)
+
+
+def run_volume_registration(mouse, opt_directory, scan_type='fluor', use_field_cache=False, atlas=None,
+    registration='landmarks', output_formats=('csv',), figures='inline', outlier_threshold=3.0):
+
+    """
+    Maps the probe annotations of one mouse to CCF coordinates
+
+    The coordinate tables are written before any figure is drawn. figures is
+    'inline' (render here), 'background' (render in a separate Agg process; see
+    start_figure_process), 'deferred' (return the arguments of
+    render_probe_figures for the caller to render) or None (no figures).
+    Run as a script, the default is 'background'. Inline rendering outside an
+    interactive session switches matplotlib to the Agg backend first.
+
+    With landmark registration, the leave-one-out error of every landmark is
+    saved to landmark_loo_errors.csv and outliers (see landmark_loo_errors)
+    are reported before the probes are transformed.
+
+    Returns
+    =======
+    process (for 'background'), arguments (for 'deferred') or None
+
+    """
 
 #if __name__ == "__main__":
 
@@ -341,39 +763,109 @@ def run_volume_registration(mouse, opt_directory, scan_type='fluor'):
     probe_annotations = pd.read_csv(fname, index_col = 0)
 
     volume = loadVolume(os.path.join(opt_directory,'mouse' + mouse +'_' + scan_type + '.pvl.nc.001'))
-    #template = loadVolume('/mnt/md0/data/opt/template_brain/template_fluor.pvl.nc.001')
-    #template = loadVolume(r"\\allen\programs\mindscope\workgroups\np-behavior\template_fluor.pvl.nc.001")
-    template = loadVolume(r"C:\Users\svc_ccg\Desktop\Data\Atlas\template_fluor.pvl.nc.001")
-    # template = loadVolume(r"D:\CCF_temp\template_fluor.pvl.nc.001")
-    
-    #labels = np.load('/mnt/md0/data/opt/annotation_volume_10um_by_index.npy')
-    #labels = np.load(r"\\allen\programs\mindscope\workgroups\np-behavior\annotation_volume_10um_by_index.npy")
-    labels = np.load(r"C:\Users\svc_ccg\Desktop\Data\Atlas\annotation_volume_10um_by_index.npy")
-    # labels = np.load(r"D:\CCF_temp\annotation_volume_10um_by_index.npy")
 
-    source_landmarks = np.load(os.path.join(opt_directory, 'landmark_annotations.npy'))
-    #arget_landmarks = np.load('/mnt/md0/data/opt/template_brain/landmark_annotations.npy')
-    target_landmarks = np.load(r"\\allen\programs\mindscope\workgroups\np-behavior\template_landmark_annotations.npy")
+    # Local, memory-mapped copies of the atlas files; the template itself is not needed here
+    if atlas is None:
+        atlas = AtlasCache()
 
-    #structure_tree = pd.read_csv('/mnt/md0/data/opt/template_brain/ccf_structure_tree_2017.csv')
-    structure_tree = pd.read_csv(r"\\allen\programs\mindscope\workgroups\np-behavior\ccf_structure_tree_2017.csv")
+    labels = atlas.labels
+    structure_tree = atlas.structure_tree
 
-    output_file = os.path.join(opt_directory,'initial_ccf_coordinates.csv')
+    output_file = os.path.join(opt_directory,'initial_ccf_coordinates')
     
-    output_file_a = os.path.join(opt_directory,'annotation_ccf_coordinates.csv')
+    output_file_a = os.path.join(opt_directory,'annotation_ccf_coordinates')
 
-    source_landmarks = source_landmarks[:,np.array([2,0,1])]
-    target_landmarks = target_landmarks[:,np.array([2,0,1])]
+    landmarks = None
 
-    transform = define_transform(source_landmarks, target_landmarks)
+    if registration == 'intensity':
+        # Landmark-free: reuse the field from intensity_registration.py if it belongs
+        # to this volume, or compute it
+        from intensity_registration import load_intensity_field, run_intensity_registration
+
+        transform = load_intensity_field(mouse, opt_directory, scan_type)
+
+        if transform is None:
+            transform = run_intensity_registration(mouse, opt_directory, scan_type, atlas)
+
+    else:
+        source_landmark_file = os.path.join(opt_directory, 'landmark_annotations.npy')
+        target_landmark_file = atlas.path('template_landmarks')
 
-    fig = plot_transform(source_landmarks, target_landmarks)
-    fig.savefig(os.path.join(opt_directory, 'transform_plot.png'))
+        source_landmarks = np.load(source_landmark_file)
+        target_landmarks = np.load(target_landmark_file)
+
+        source_landmarks = source_landmarks[:,np.array([2,0,1])]
+        target_landmarks = target_landmarks[:,np.array([2,0,1])]
+
+        if use_field_cache:
+            # Bake the warp onto a grid once per landmark set; later runs only interpolate
+            transform = cached_deformation_field(opt_directory, 
+                [source_landmark_file, target_landmark_file],
+                lambda: define_transform(source_landmarks, target_landmarks))
+        else:
+            transform = define_transform(source_landmarks, target_landmarks)
+
+        landmarks = (source_landmarks, target_landmarks)
+
+        loo_report = landmark_loo_errors(source_landmarks, target_landmarks, outlier_threshold)
+        loo_report.to_csv(os.path.join(opt_directory, 'landmark_loo_errors.csv'), index=False)
+
+        print('Landmark leave-one-out error: median ' + str(np.around(loo_report.error.median(), 1)) + 
+              ' voxels, max ' + str(np.around(loo_report.error.max(), 1)))
+
+        for _, outlier in loo_report[loo_report.outlier].iterrows():
+            print('  Possible bad landmark ' + str(outlier.landmark) + ': error ' + 
+                  str(np.around(outlier.error, 1)) + ' voxels')
+
+    figure_data = [] if figures is not None else None
 
     df, df_a = transform_probe_coordinates(transform, probe_annotations, 
-        labels, volume, structure_tree, opt_directory, save_figures=True)
+        labels, volume, structure_tree, opt_directory, figure_data=figure_data)
 
-    df.to_csv(output_file)
+    write_ccf_coordinates(df, output_file, output_formats)
     
-    df_a.to_csv(output_file_a)
+    write_ccf_coordinates(df_a, output_file_a, output_formats)
+
+    if figures is None:
+        return None
+
+    figure_args = (figure_data, structure_tree, opt_directory, 20, landmarks)
+
+    if figures == 'background':
+        return start_figure_process(*figure_args)
+    elif figures == 'deferred':
+        return figure_args
+
+    if not matplotlib.is_interactive() and matplotlib.get_backend().lower() != 'agg':
+        # Figures are only saved, so no GUI backend is needed
+        plt.switch_backend('Agg')
+
+    render_probe_figures(*figure_args)
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='Map the probe annotations of one mouse to CCF coordinates')
+    parser.add_argument('mouse')
+    parser.add_argument('opt_directory')
+    parser.add_argument('--scan-type', default='fluor', choices=['fluor', 'trans'])
+    parser.add_argument('--registration', default='landmarks', choices=['landmarks', 'intensity'])
+    parser.add_argument('--use-field-cache', action='store_true')
+    parser.add_argument('--output-formats', nargs='+', default=['csv'], choices=['csv', 'parquet', 'feather'])
+    parser.add_argument('--figures', default='background', choices=['background', 'inline', 'none'],
+                        help='background = render in a separate Agg process after the tables are written')
+    args = parser.parse_args(argv)
+
+    process = run_volume_registration(args.mouse, args.opt_directory, args.scan_type,
+                                      use_field_cache=args.use_field_cache, registration=args.registration,
+                                      output_formats=args.output_formats,
+                                      figures=None if args.figures == 'none' else args.figures)
+
+    if process is not None:
+        print('Coordinates written, rendering figures')
+        process.join()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
 
@@ -0,0 +1,161 @@
+import numpy as np
+import os
+import sys
+import argparse
+import time
+
+from multiprocessing import Pool
+
+from scipy.ndimage import map_coordinates
+
+from volume_registration import define_transform, memmap_volume, HEADER_SIZE
+from deformation_field import DeformationField, cached_deformation_field, deformation_field_path
+from opt_volume_creator import create_header, write_nc_header
+from atlas_cache import AtlasCache
+
+
+def create_volume_file(fname, shape=(1023, 1024, 1024)):
+
+    """
+    Creates an empty Drishti volume (.pvl.nc and .pvl.nc.001) to be filled in place
+
+    """
+
+    with open(fname + '.001', 'wb') as f:
+        create_header().tofile(f)
+        f.truncate(HEADER_SIZE + int(np.prod(shape)))
+
+    write_nc_header(fname)
+
+    return memmap_volume(fname + '.001', mode='r+')
+
+
+_worker = {}
+
+def _init_worker(volume_file, output_file, field_file, order, fill_value):
+
+    _worker['volume'] = memmap_volume(volume_file)
+    _worker['output'] = memmap_volume(output_file, mode='r+')
+    _worker['field'] = DeformationField.load(field_file, mmap_mode='r')
+    _worker['order'] = order
+    _worker['fill_value'] = fill_value
+
+
+def _warp_slab(slab):
+
+    start, stop = slab
+
+    volume = _worker['volume']
+    output = _worker['output']
+
+    n, nx, ny = stop - start, output.shape[1], output.shape[2]
+
+    # Output voxel [i,j,k] is the point (i, k, j) in the landmark frame
+    i, j, k = np.meshgrid(np.arange(start, stop), np.arange(nx), np.arange(ny), indexing='ij')
+    points = np.column_stack((i.ravel(), k.ravel(), j.ravel()))
+
+    source = _worker['field'].transform_points(points)
+
+    # ... and the landmark frame point (p0, p1, p2) is OPT voxel [p0, p2, p1]
+    warped = map_coordinates(volume, source[:, np.array([0,2,1])].T,
+                             order=_worker['order'], cval=_worker['fill_value'])
+
+    output[start:stop] = np.clip(np.around(warped), 0, 255).astype('uint8').reshape(n, nx, ny)
+    output.flush()
+
+    return stop - start
+
+
+def warp_volume(mouse, opt_directory, scan_type='fluor', processes=None, slab_size=4,
+                spacing=4, order=1, fill_value=0, inverse_field=True):
+
+    """
+    Resamples an OPT volume into template (CCF-aligned) space
+
+    The template-to-OPT warp is the inverse of the cached OPT-to-template
+    deformation field, so the warped volume lines up with the probe CCF
+    coordinates. Slabs of the output
+    are resampled in parallel from the memory-mapped OPT volume and written
+    straight into the output file.
+
+    Parameters
+    ==========
+    mouse - mouse ID (string)
+    opt_directory - directory with the OPT volume and landmark_annotations.npy
+    scan_type - 'fluor' or 'trans'
+    processes - number of worker processes (default = number of CPUs)
+    slab_size - output slices resampled per task
+    spacing - deformation field grid spacing in voxels
+    order - spline interpolation order (0 = nearest, 1 = trilinear)
+    fill_value - value for voxels that map outside the OPT volume
+    inverse_field - if False, use a thin-plate spline fitted with source and target
+                    landmarks swapped instead; this is only approximately the
+                    inverse of the warp used for the probe coordinates
+
+    Returns
+    =======
+    output_file - path of the warped volume (.pvl.nc)
+
+    """
+
+    volume_file = os.path.join(opt_directory, 'mouse' + mouse + '_' + scan_type + '.pvl.nc.001')
+    output_file = os.path.join(opt_directory, 'mouse' + mouse + '_' + scan_type + '_ccf.pvl.nc')
+
+    source_landmark_file = os.path.join(opt_directory, 'landmark_annotations.npy')
+    target_landmark_file = AtlasCache().path('template_landmarks')
+
+    source_landmarks = np.load(source_landmark_file)[:,np.array([2,0,1])]
+    target_landmarks = np.load(target_landmark_file)[:,np.array([2,0,1])]
+
+    if inverse_field:
+        # Same cache key as the forward field of run_volume_registration
+        landmark_files = [source_landmark_file, target_landmark_file]
+        build_transform = lambda: define_transform(source_landmarks, target_landmarks)
+    else:
+        # Landmark files in target, source order: the swapped warp gets its own cache key
+        landmark_files = [target_landmark_file, source_landmark_file]
+        build_transform = lambda: define_transform(target_landmarks, source_landmarks)
+
+    cached_deformation_field(opt_directory, landmark_files, build_transform,
+                             spacing=spacing, inverse=inverse_field)
+
+    field_file = deformation_field_path(opt_directory, landmark_files, spacing=spacing, inverse=inverse_field)
+
+    output = create_volume_file(output_file)
+    num_slices = output.shape[0]
+    del output
+
+    print('Warping ' + volume_file + '...')
+
+    start_time = time.time()
+
+    slabs = [(start, min(start + slab_size, num_slices)) for start in range(0, num_slices, slab_size)]
+
+    with Pool(processes, _init_worker, (volume_file, output_file + '.001', field_file, order, fill_value)) as pool:
+        for done, _ in enumerate(pool.imap(_warp_slab, slabs)):
+            if done % 32 == 0:
+                print('  ' + str(slabs[done][1]) + ' / ' + str(num_slices))
+
+    print('  Done in ' + str(np.around(time.time() - start_time, 1)) + ' s')
+
+    return output_file
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='Warp an OPT volume into template (CCF-aligned) space')
+    parser.add_argument('mouse')
+    parser.add_argument('opt_directory')
+    parser.add_argument('--scan-type', default='fluor', choices=['fluor', 'trans'])
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--order', type=int, default=1, help='0 = nearest, 1 = trilinear')
+    parser.add_argument('--swapped-landmarks', action='store_true',
+                        help='fit a spline with swapped landmarks instead of inverting the field (approximate)')
+    args = parser.parse_args(argv)
+
+    warp_volume(args.mouse, args.opt_directory, args.scan_type,
+                processes=args.processes, order=args.order, inverse_field=not args.swapped_landmarks)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
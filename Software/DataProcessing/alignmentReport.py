@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch alignment assessment over many test-object acquisitions.
+
+Runs assessTestObject on every acquisition listed in a CSV file, in parallel, and
+writes one table of ellipse parameters, point spread statistics and suggested
+stage corrections, plus a figure per acquisition. Rerun over new acquisitions to
+track instrument drift over time.
+
+The acquisition list needs columns rig, date and folder. Optional columns override
+the command line defaults per acquisition: imgStep, pointRangeMin, pointRangeMax,
+invertImg, detectionType.
+
+Usage:
+    python alignmentReport.py <acquisitions.csv> <output_folder> [--processes N]
+
+"""
+
+import argparse
+import csv
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg') # Headless: figures are only saved, never shown
+
+import numpy as np
+
+import assessTestObject
+
+
+REPORT_COLUMNS = ['rig', 'date', 'folder', 'status', 'seconds',
+                  'centerX', 'centerY', 'majorAxis', 'minorAxis', 'angle',
+                  'numPoints', 'numInliers', 'rmsResidual',
+                  'stdAll', 'stdFirstHalf', 'meanFirstHalf', 'stdSecondHalf', 'meanSecondHalf',
+                  'stdFirstQuad', 'meanFirstQuad', 'stdThirdQuad', 'meanThirdQuad',
+                  'leftRight', 'frontBack', 'figure', 'error']
+
+
+def readAcquisitions(acquisitionFile, defaults):
+    # Read acquisition list, filling per-acquisition parameters from defaults
+
+    acquisitions = []
+
+    with open(acquisitionFile, 'r') as f:
+        for row in csv.DictReader(f):
+            acq = dict(defaults)
+            acq['rig'] = row['rig']
+            acq['date'] = row['date']
+            acq['folder'] = row['folder']
+
+            if row.get('imgStep'):
+                acq['imgStep'] = int(row['imgStep'])
+            if row.get('pointRangeMin') and row.get('pointRangeMax'):
+                acq['pointRange'] = [float(row['pointRangeMin']), float(row['pointRangeMax'])]
+            if row.get('invertImg'):
+                acq['invertImg'] = row['invertImg'].strip().lower() in ('1', 'true', 'yes')
+            if row.get('detectionType'):
+                acq['detectionType'] = row['detectionType']
+
+            acquisitions.append(acq)
+
+    return acquisitions
+
+def assessAcquisition(acq, outputFolder, suggestCorrections, detectionWorkers = 2):
+    # Run detection, robust ellipse fit, summary statistics and corrections for one acquisition
+    # Returns one report row. Failures are recorded in the row rather than raised.
+
+    row = {'rig': acq['rig'], 'date': acq['date'], 'folder': acq['folder']}
+    startTime = time.time()
+
+    try:
+        dstAccum, cornerList = assessTestObject.main(acq['folder'], acq['imgStep'], acq['detectionType'],
+                                                     acq['subpixelFitting'], invertImg = acq['invertImg'],
+                                                     pointRange = acq['pointRange'], workers = detectionWorkers)
+
+        if acq['detectionType'] == 'bead':
+            tracks = assessTestObject.trackBeads(cornerList)
+            params, beadFits = assessTestObject.fitBeadTracks(cornerList, tracks)
+            cornerList = cornerList[max(tracks, key=len)]
+            trackParams, elipFit, fitStats = assessTestObject.fitEllipseRobust(cornerList[:,0:2])
+        else:
+            params, elipFit, fitStats = assessTestObject.fitEllipseRobust(cornerList[:,0:2])
+
+        corrections = assessTestObject.computeCorrections(params, suggestCorrections)
+
+        figureName = '{}_{}_alignment.png'.format(acq['rig'], acq['date'])
+        assessTestObject.plotOutput(dstAccum, cornerList, elipFit,
+                                    savePath = os.path.join(outputFolder, figureName),
+                                    title = '{} {}'.format(acq['rig'], acq['date']))
+
+        row.update({'status': 'ok',
+                    'centerX': params[0], 'centerY': params[1],
+                    'majorAxis': params[2], 'minorAxis': params[3], 'angle': params[4],
+                    'numPoints': fitStats['numPoints'], 'numInliers': fitStats['numInliers'],
+                    'rmsResidual': fitStats['rmsResidual'],
+                    'leftRight': corrections['leftRight'], 'frontBack': corrections['frontBack'],
+                    'figure': figureName})
+        row.update(assessTestObject.summarizeCornerList(cornerList))
+
+    except Exception as e:
+        row.update({'status': 'failed', 'error': repr(e)})
+        traceback.print_exc()
+
+    row['seconds'] = time.time() - startTime
+
+    return row
+
+def runReport(acquisitions, outputFolder, suggestCorrections, processes = None, detectionWorkers = 2):
+    # Assess all acquisitions over a process pool and write alignment_report.csv
+    # Rows are sorted by rig then date so drift reads down the table
+
+    if not os.path.isdir(outputFolder):
+        os.makedirs(outputFolder)
+
+    rows = []
+
+    with ProcessPoolExecutor(max_workers = processes) as pool:
+        futures = [pool.submit(assessAcquisition, acq, outputFolder, suggestCorrections, detectionWorkers)
+                   for acq in acquisitions]
+
+        for future in futures:
+            row = future.result()
+            print('{} {}: {} in {:.1f} s'.format(row['rig'], row['date'], row['status'], row['seconds']))
+            rows.append(row)
+
+    rows.sort(key = lambda r: (r['rig'], r['date']))
+
+    reportFile = os.path.join(outputFolder, 'alignment_report.csv')
+
+    with open(reportFile, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames = REPORT_COLUMNS)
+        writer.writeheader()
+
+        for row in rows:
+            writer.writerow({key: (np.round(value, 4) if isinstance(value, float) else value)
+                             for key, value in row.items()})
+
+    print('Wrote ' + reportFile)
+
+    return rows
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='Batch alignment report from test-object acquisitions')
+    parser.add_argument('acquisitionFile', help='CSV with columns rig, date, folder')
+    parser.add_argument('outputFolder')
+    parser.add_argument('--processes', type=int, default=None, help='acquisitions assessed at once')
+    parser.add_argument('--detection-workers', type=int, default=2, help='detection threads per acquisition')
+    parser.add_argument('--img-step', type=int, default=11)
+    parser.add_argument('--point-range', type=float, nargs=2, default=[1600, 1650])
+    parser.add_argument('--no-invert', action='store_true', help='do not flip images up-down')
+    parser.add_argument('--detection-type', default='corner')
+    parser.add_argument('--stage-corners', type=float, nargs=2, default=[124.5, 76.2], help='L-R, back-front, mm')
+    parser.add_argument('--rotates-towards', default='back')
+    parser.add_argument('--specimen-start-side', default='left')
+    args = parser.parse_args(argv)
+
+    defaults = {'imgStep': args.img_step,
+                'pointRange': args.point_range,
+                'invertImg': not args.no_invert,
+                'detectionType': args.detection_type,
+                'subpixelFitting': True}
+
+    suggestCorrections = {'output': True,
+                          'stageCorners': args.stage_corners,
+                          'rotatesTowards': args.rotates_towards,
+                          'specimenStartSide': args.specimen_start_side}
+
+    acquisitions = readAcquisitions(args.acquisitionFile, defaults)
+
+    runReport(acquisitions, args.outputFolder, suggestCorrections,
+              processes = args.processes, detectionWorkers = args.detection_workers)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
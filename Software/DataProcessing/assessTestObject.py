@@ -7,30 +7,79 @@ Created on Thu Aug 08 14:20:57 2019
 
 import os
 import re
+import time
 import cv2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 import tifffile
 from matplotlib.patches import Ellipse
 
 
-def optFeatureDetector(img, featureType = 'corner', subPixel = False):
+# Rows added above and below a band-limited detection region. Covers the Harris
+# block and Sobel aperture, the dilation, the extent of a thresholded corner blob
+# and the cornerSubPix search window, so features inside the band are unaffected.
+BAND_MARGIN = 32
+
+def cornerResponse(binImg):
+    # Dilated Harris corner response of a binary image
+    
+    dst = cv2.cornerHarris(binImg,12,5,0.04)
+    
+    return cv2.dilate(dst,None)
+
+def cornerResponseRange(img):
+    # (median, peak) of the whole-frame corner response of img. Computed once, e.g. from the
+    # first plane of a scan, and passed to optFeatureDetector as responseRange so band-limited
+    # detection does not need the whole frame for every plane.
+    
+    threshold = (np.amax(img) - np.amin(img))/2 + np.amin(img)
+    dst = cornerResponse((img < threshold).astype('float32'))
+    
+    return (np.median(dst), np.amax(dst))
+
+def optFeatureDetector(img, featureType = 'corner', subPixel = False, rowRange = None, responseRange = None):
     # Take an image and return centroids for all features detected in image
+    #
+    # rowRange - optional (min, max) y range of interest. Thresholding, labelling and sub-pixel
+    #   fitting then run only on these rows plus BAND_MARGIN, centroids are returned in frame
+    #   coordinates and the background component is dropped. The corner response is scaled
+    #   with the median and peak of the whole frame (responseRange if given), so results match
+    #   full-frame detection when responseRange comes from the same frame.
+    # responseRange - optional (median, peak) of the whole-frame corner response, as returned by
+    #   cornerResponseRange. If given with rowRange, the response is only computed on the band
+    #   instead of the whole frame.
+    
+    if rowRange is not None:
+        top = max(int(np.floor(np.amin(rowRange))) - BAND_MARGIN, 0)
+        bottom = min(int(np.ceil(np.amax(rowRange))) + BAND_MARGIN + 1, img.shape[0])
+    else:
+        top = 0
+        bottom = img.shape[0]
     
     if featureType == 'corner':
-        # binarize
-        binImg = (img < ((np.amax(img) - np.amin(img))/2 + np.amin(img))).astype('float32')
+        # binarize. Threshold is taken from the whole frame so a band-limited binary image matches
+        threshold = (np.amax(img) - np.amin(img))/2 + np.amin(img)
+        
+        if rowRange is not None and responseRange is not None:
+            binImg = (img[top:bottom] < threshold).astype('float32')
+        else:
+            binImg = (img < threshold).astype('float32')
             
         # Detect corner
-        dst = cv2.cornerHarris(binImg,12,5,0.04)
-    
-        dst = cv2.dilate(dst,None)
+        dst = cornerResponse(binImg)
+        
+        if responseRange is None:
+            responseRange = (np.median(dst), np.amax(dst))
+            dst = dst[top:bottom]
         
         # Scale so background is 0.  Peak is 255.  Any values < bkgd are negative.
-        dstScale = 255*((dst - np.median(dst))/(np.amax(dst) - np.median(dst)))
+        dstScale = 255*((dst - responseRange[0])/(responseRange[1] - responseRange[0]))
         
 #        ret, dstBin = cv2.threshold(dst,(0.1*np.amax(dstScale)),255,0)
-        dstBin = 255*np.uint8(dstScale > (0.1*np.amax(dstScale)))
+        # 0.1 of the whole-frame peak, which scales to 255
+        dstBin = 255*np.uint8(dstScale > (0.1*255))
         
         # find centroids
         ret, labels, stats, centroids = cv2.connectedComponentsWithStats(dstBin)
@@ -38,9 +87,169 @@ def optFeatureDetector(img, featureType = 'corner', subPixel = False):
         if subPixel:
             criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.001)
             centroids = cv2.cornerSubPix(dstScale,np.float32(centroids),(12,12),(-1,-1),criteria)
+            
+        if rowRange is not None:
+            # Background component centroid falls inside a cropped band. Drop it
+            centroids = centroids[1:]
+            
+    elif featureType == 'bead':
+        centroids, dstScale = beadDetector(img[top:bottom], subPixel = subPixel)
+        
+    else:
+        raise ValueError('Feature type must be \'corner\' or \'bead\'')
+    
+    if rowRange is not None:
+        # Shift to frame coordinates
+        centroids = centroids.astype('float64')
+        centroids[:,1] += top
+        
+        dstFrame = np.zeros(img.shape, dtype = dstScale.dtype)
+        dstFrame[top:bottom] = dstScale
+        dstScale = dstFrame
+        
+    return centroids, dstScale
+
+def gaussianBoxBlur(img, sigma, passes = 3):
+    # Approximate a Gaussian blur with repeated box filters. Each pass is separable and
+    # costs the same for any sigma, so large scales are as cheap as small ones.
+    width = int(np.round(np.sqrt(12*sigma*sigma/passes + 1)))
+    width += 1 - width % 2 # Odd width keeps the filter centered
+    
+    for p in range(passes):
+        img = cv2.boxFilter(img, -1, (width, width), borderType = cv2.BORDER_REFLECT)
         
+    return img
+
+def beadDetector(img, sigmas = (1.5, 2.5, 4, 6), threshold = 8, polarity = 'bright', subPixel = False):
+    # Find beads in an image as local maxima of a multi-scale difference of Gaussians
+    #
+    # sigmas - scales searched. Beads of radius about sigma*sqrt(2) respond most strongly
+    # threshold - minimum response in robust standard deviations (MAD) above the median
+    # polarity - 'bright' for fluorescent beads, 'dark' for absorbing beads in transmission
+    # Returns centroids (N x 2, x y) and response scaled as in the corner detector
+    
+    img = img.astype('float32')
+    
+    if polarity == 'dark':
+        img = -img
+    
+    # Scale-normalized DoG response, maximum over scales
+    response = np.full(img.shape, -np.inf, dtype='float32')
+    
+    for sigma in sigmas:
+        dog = gaussianBoxBlur(img, sigma) - gaussianBoxBlur(img, 1.6*sigma)
+        np.maximum(response, dog, out = response)
+        
+    median = np.median(response)
+    mad = 1.4826*np.median(np.abs(response - median)) + 1e-12
+    
+    # Local maxima above threshold
+    localMax = response == cv2.dilate(response, np.ones((5,5), np.uint8))
+    peaks = localMax & (response > median + threshold*mad)
+    
+    # Keep off the border, where the subpixel neighbourhood is incomplete
+    peaks[[0,-1],:] = False
+    peaks[:,[0,-1]] = False
+    
+    y, x = np.nonzero(peaks)
+    centroids = np.column_stack((x, y)).astype('float64')
+    
+    if subPixel and len(y) > 0:
+        # Parabolic peak interpolation along each axis
+        center = response[y, x]
+        for axis, (dy, dx) in enumerate([(0, 1), (1, 0)]):
+            before = response[y - dy, x - dx]
+            after = response[y + dy, x + dx]
+            denom = before - 2*center + after
+            denom[denom == 0] = -np.inf
+            centroids[:,axis] += 0.5*(before - after)/denom
+    
+    dstScale = 255*((response - median)/(np.amax(response) - median + 1e-12))
+    
     return centroids, dstScale
 
+def trackBeads(cornerList, maxJump = 20):
+    # Link bead detections across consecutive planes into tracks
+    # cornerList - rows of (x, y, angle) in angle order, as returned by main
+    # maxJump - largest movement in pixels between sampled planes
+    # Returns list of row index arrays into cornerList, one per track
+    
+    angles = np.unique(cornerList[:,2])
+    tracks = []
+    active = [] # Indices into tracks still extended by the previous plane
+    
+    for angle in angles:
+        rows = np.nonzero(cornerList[:,2] == angle)[0]
+        
+        if len(active) > 0 and len(rows) > 0:
+            last = cornerList[[tracks[t][-1] for t in active], :2]
+            distance = np.sqrt(np.sum((last[:,None,:] - cornerList[rows][None,:,:2])**2, axis=2))
+        else:
+            distance = np.zeros((len(active), len(rows)))
+        
+        # Greedy assignment, closest pairs first
+        assigned = np.zeros(len(rows), dtype=bool)
+        continued = []
+        
+        for flat in np.argsort(distance, axis=None):
+            t, r = np.unravel_index(flat, distance.shape)
+            if distance[t, r] > maxJump:
+                break
+            if active[t] in continued or assigned[r]:
+                continue
+            tracks[active[t]].append(rows[r])
+            continued.append(active[t])
+            assigned[r] = True
+        
+        # Unmatched detections start new tracks
+        for r in np.nonzero(~assigned)[0]:
+            tracks.append([rows[r]])
+            continued.append(len(tracks) - 1)
+            
+        active = continued
+        
+    return [np.array(t) for t in tracks]
+
+def fitBeadTracks(cornerList, tracks, minPoints = 20):
+    # Fit an ellipse to each bead track and combine into one multi-point alignment estimate
+    # Axis tilt and the minor/major ratio are the same for every bead whatever its radius,
+    # so their medians over beads give a robust estimate.
+    # Returns combined params (as fitEllipseCorrected) and per-bead fits (N x 5, major axis first)
+    
+    fits = []
+    
+    for track in tracks:
+        if len(track) < minPoints:
+            continue
+        
+        try:
+            params, ell_coord, stats = fitEllipseRobust(cornerList[track, :2])
+        except (ValueError, np.linalg.LinAlgError):
+            continue
+        
+        cx, cy, a, b, angle = params
+        
+        # Order axes major first, with the angle referring to the major axis
+        if a < b:
+            a, b = b, a
+            angle = angle + 90
+        angle = (angle + 90) % 180 - 90
+        
+        if np.all(np.isfinite([cx, cy, a, b, angle])):
+            fits.append([cx, cy, a, b, angle])
+            
+    if len(fits) == 0:
+        raise ValueError('No bead track long enough to fit')
+    
+    fits = np.array(fits)
+    
+    ratio = np.median(fits[:,3]/fits[:,2])
+    major = np.median(fits[:,2])
+    
+    params = [np.median(fits[:,0]), np.median(fits[:,1]), major, major*ratio, np.median(fits[:,4])]
+    
+    return params, fits
+
 def ellipse(R, xCenter, yCenter, majAxis, minAxis, phi, flattenResult = False):
   
     xx = xCenter + majAxis*np.cos(R)*np.cos(phi) - minAxis*np.sin(R)*np.sin(phi)
@@ -53,8 +262,9 @@ def ellipse(R, xCenter, yCenter, majAxis, minAxis, phi, flattenResult = False):
     else:
         return [xx, yy]
     
-def fitEllipseCorrected(cont):
-# https://stackoverflow.com/questions/39693869/fitting-an-ellipse-to-a-set-of-data-points-in-python
+def ellipseScatter(cont):
+    # Scatter matrix D'D of the conic design matrix for points (N x 2)
+    # Scatter matrices of disjoint point sets add, so a fit can be updated incrementally
     x=cont[:,0]
     y=cont[:,1]
 
@@ -62,7 +272,16 @@ def fitEllipseCorrected(cont):
     y=y[:,None]
 
     D=np.hstack([x*x,x*y,y*y,x,y,np.ones(x.shape)])
-    S=np.dot(D.T,D)
+    
+    return np.dot(D.T,D)
+
+def fitEllipseCorrected(cont):
+# https://stackoverflow.com/questions/39693869/fitting-an-ellipse-to-a-set-of-data-points-in-python
+
+    return fitEllipseFromScatter(ellipseScatter(cont))
+
+def fitEllipseFromScatter(S):
+    # Direct least-squares ellipse fit from a 6 x 6 scatter matrix (see ellipseScatter)
     C=np.zeros([6,6])
     C[0,2]=C[2,0]=2
     C[1,1]=-1
@@ -89,7 +308,7 @@ def fitEllipseCorrected(cont):
     b=np.sqrt(abs(up/down2))
 
     #---------------------Get path---------------------
-    ell=Ellipse((cx,cy),a*2.,b*2.,angle)
+    ell=Ellipse((cx,cy),a*2.,b*2.,angle=angle)
     ell_coord=ell.get_verts()
 
     params=[cx,cy,a,b,angle]
@@ -97,65 +316,233 @@ def fitEllipseCorrected(cont):
     return params,ell_coord
 
 
-def main(imgFolder, imgStep, detectionType, subpixelFitting):
-    # Main method of feature detection
-    # Takes input folder path, parameters for fitting
-    # Returns filtered image enhancing features and localized positions of features
+def conicSampsonDistance(conics, points):
+    # First-order geometric distance of points (N x 2) to each conic (H x 6, coefficients
+    # of x^2, xy, y^2, x, y, 1). Returns H x N distances.
+    x = points[:,0][None,:]
+    y = points[:,1][None,:]
+    A, B, C, D, E, F = [conics[:,i][:,None] for i in range(6)]
+    
+    value = A*x*x + B*x*y + C*y*y + D*x + E*y + F
+    gradX = 2*A*x + B*y + D
+    gradY = B*x + 2*C*y + E
+    
+    return np.abs(value)/np.sqrt(gradX*gradX + gradY*gradY + 1e-30)
 
+def fitEllipseRobust(cont, numHypotheses = 500, threshold = 2.0, seed = None):
+    # RANSAC ellipse fit, robust to spurious corners
+    # All hypotheses are 5-point conics solved together in one batched SVD and scored
+    # together by Sampson distance. The largest consensus set is refit with fitEllipseCorrected.
+    #
+    # threshold - inlier distance in pixels
+    # Returns params, ell_coord as fitEllipseCorrected, and dict of inlier statistics
+    
+    rng = np.random.RandomState(seed)
+    numPoints = len(cont)
+    
+    if numPoints < 6:
+        raise ValueError('At least 6 points needed for a robust ellipse fit')
+    
+    # Normalize coordinates for a well conditioned solve
+    center = np.mean(cont, axis=0)
+    scale = np.sqrt(np.mean(np.sum((cont - center)**2, axis=1)))
+    pts = (cont - center)/scale
+    
+    x = pts[:,0][:,None]
+    y = pts[:,1][:,None]
+    design = np.hstack([x*x, x*y, y*y, x, y, np.ones(x.shape)])
+    
+    # Minimal samples of 5 distinct points, one row per hypothesis
+    samples = np.argsort(rng.rand(numHypotheses, numPoints), axis=1)[:,:5]
+    
+    # Conic through 5 points is the null vector of the 5 x 6 design matrix
+    u, sv, vt = np.linalg.svd(design[samples])
+    conics = vt[:,-1,:]
+    
+    # Keep hypotheses that are ellipses: B^2 - 4AC < 0
+    isEllipse = conics[:,1]**2 - 4*conics[:,0]*conics[:,2] < 0
+    
+    distance = conicSampsonDistance(conics, pts)*scale
+    inliers = (distance < threshold) & isEllipse[:,None]
+    
+    # Most inliers wins, ties broken by lowest inlier residual
+    numInliers = np.sum(inliers, axis=1)
+    residual = np.sum(np.where(inliers, distance, 0), axis=1)
+    best = np.lexsort((residual, -numInliers))[0]
+    
+    inlierMask = inliers[best]
+    
+    if np.sum(inlierMask) < 6:
+        raise ValueError('No ellipse consensus found')
+    
+    params, ell_coord = fitEllipseCorrected(cont[inlierMask])
+    
+    # Rescore against the refined fit. Conic from its scatter matrix solution, in pixels
+    refinedConic = ellipseConic(params)
+    refinedDistance = conicSampsonDistance(refinedConic[None,:], cont)[0]
+    refinedMask = refinedDistance < threshold
+    
+    if np.sum(refinedMask) >= 6 and np.sum(refinedMask) > np.sum(inlierMask):
+        inlierMask = refinedMask
+        params, ell_coord = fitEllipseCorrected(cont[inlierMask])
+        refinedDistance = conicSampsonDistance(ellipseConic(params)[None,:], cont)[0]
+    
+    stats = {'numPoints': numPoints,
+             'numInliers': int(np.sum(inlierMask)),
+             'inlierFraction': np.mean(inlierMask),
+             'rmsResidual': np.sqrt(np.mean(refinedDistance[inlierMask]**2)),
+             'validHypotheses': int(np.sum(isEllipse)),
+             'inlierMask': inlierMask}
+    
+    return params, ell_coord, stats
+
+def ellipseConic(params):
+    # Conic coefficients (x^2, xy, y^2, x, y, 1) of an ellipse [cx, cy, a, b, angle in degrees]
+    cx, cy, a, b, angle = params
+    phi = np.radians(angle)
+    c, s = np.cos(phi), np.sin(phi)
+    
+    A = (c/a)**2 + (s/b)**2
+    B = 2*c*s*(1/a**2 - 1/b**2)
+    C = (s/a)**2 + (c/b)**2
+    D = -2*A*cx - B*cy
+    E = -B*cx - 2*C*cy
+    F = A*cx*cx + B*cx*cy + C*cy*cy - 1
+    
+    return np.array([A, B, C, D, E, F])
+
+def listPlaneFiles(imgFolder):
     # Get list of files. Is defined by imgRot_XXXX.tif, where XXXX is position in image series.
     # Is a folder with a list of files
     onlyFiles = [f for f in os.listdir(imgFolder) if os.path.isfile(os.path.join(imgFolder, f)) and re.search('imgRot_\d{4}.tif', f)]
     
-    if len(onlyFiles) is 0:
+    if len(onlyFiles) == 0:
         onlyFiles = [f for f in os.listdir(imgFolder) if os.path.isfile(os.path.join(imgFolder, f)) and re.search('\W+ome.tif', f)]
     
+    # os.listdir order is arbitrary. Zero-padded names sort in acquisition (angle) order
+    return sorted(onlyFiles)
+
+def readPlanes(imgFolder, onlyFiles, planeIndices, invertImg = False):
+    # Generator over (index, image) for the requested planes
+    # A single MicroManager ome.tiff file is opened once for all planes
+    
+    if len(onlyFiles) == 1:
+        with tifffile.TiffFile(os.path.join(imgFolder, onlyFiles[0])) as tif:
+            for k in planeIndices:
+                img = np.rot90(tif.pages[k].asarray(), -1)
+                
+                if invertImg:
+                    img = np.flipud(img)
+                    
+                yield k, img
+    else:
+        for k in planeIndices:
+            with tifffile.TiffFile(os.path.join(imgFolder, onlyFiles[k])) as tif:
+                img = tif.asarray()
+                
+            if invertImg:
+                img = np.flipud(img)
+                
+            yield k, img
+
+def detectPlanes(planes, detectionType, subpixelFitting, workers = None, rowRange = None):
+    # Run optFeatureDetector over planes on a thread pool. OpenCV releases the GIL,
+    # so threads run detection in parallel while the next planes are read.
+    # Yields (index, image, centroids, dst) in input order.
+    # With rowRange, corner detection is scaled by the whole-frame response of the first plane
+    # and only computed on the band for every plane.
+    
+    if workers is None:
+        workers = os.cpu_count()
+    
+    def detect(k, img, responseRange):
+        centroids, dst = optFeatureDetector(img, subPixel = subpixelFitting, featureType = detectionType,
+                                            rowRange = rowRange, responseRange = responseRange)
+        return k, img, centroids, dst
+    
+    pending = deque()
+    responseRange = None
+    
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        for k, img in planes:
+            if responseRange is None and rowRange is not None and detectionType == 'corner':
+                responseRange = cornerResponseRange(img)
+                
+            pending.append(pool.submit(detect, k, img, responseRange))
+            
+            # Bound the number of planes held in memory
+            while len(pending) > 2*workers:
+                yield pending.popleft().result()
+                
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+def appendPoints(buffer, count, points, angle):
+    # Write points (N x 2) and their rotation angle into rows count:count+N of buffer.
+    # Buffer capacity doubles when full so total copying stays linear in the number of points.
+    # Returns buffer (possibly reallocated) and new count
+    
+    newCount = count + len(points)
+    
+    if newCount > len(buffer):
+        grown = np.empty((max(newCount, 2*len(buffer)), buffer.shape[1]), dtype=buffer.dtype)
+        grown[:count] = buffer[:count]
+        buffer = grown
+        
+    buffer[count:newCount, :2] = points
+    buffer[count:newCount, 2] = angle
+    
+    return buffer, newCount
+
+def main(imgFolder, imgStep, detectionType, subpixelFitting, invertImg = False, pointRange = [], workers = None):
+    # Main method of feature detection
+    # Takes input folder path, parameters for fitting
+    # Returns filtered image enhancing features and localized positions of features
+    #
+    # invertImg - flip image up-down
+    # pointRange - [min, max] y range of points to keep. Empty keeps the lowest point in each plane
+    # workers - number of detection threads. Default: all cores
+
+    onlyFiles = listPlaneFiles(imgFolder)
+    
     # Is a single MicroManager ome.tiff file
     if len(onlyFiles) == 1:
-        isSeries = False
-        numPlanes = len(tifffile.TiffFile(os.path.join(imgFolder, onlyFiles[0])).pages)
+        with tifffile.TiffFile(os.path.join(imgFolder, onlyFiles[0])) as tif:
+            numPlanes = len(tif.pages)
     else:
-        isSeries = True
         numPlanes = len(onlyFiles)
     
     
-    cornerList = np.array([])
-    dstAccum = np.array([])
-    imgAccum = np.array([])
+    planeIndices = range(0, numPlanes, imgStep)
+    
+    # Preallocated results: one point per sampled plane is typical, buffer grows by doubling if exceeded.
+    # Accumulation images are allocated once the frame size is known, then added to in place.
+    cornerBuffer = np.empty((len(planeIndices), 3))
+    numCorners = 0
+    dstAccum = None
+    imgAccum = None
     #
     angleStep = 2*np.pi/numPlanes
     
+    planes = readPlanes(imgFolder, onlyFiles, planeIndices, invertImg)
     
-    for k in range(0, numPlanes, imgStep):
-    #for k in range(0, 200, imgStep):
-        
-        print('Analyzing plane {}'.format(k))
-        
-        
-        
-        # Load file
-        if isSeries:
-            f = onlyFiles[k]
-            with tifffile.TiffFile(os.path.join(imgFolder, f)) as tif:
-                img = tif.asarray()
-        else:
-            img = np.rot90(tifffile.imread(os.path.join(imgFolder, onlyFiles[0]), key=k), -1)
-            
-        if invertImg:
-            img = np.flipud(img)
-            
+    # Only the pointRange band needs to be searched for features
+    if len(pointRange) == 2:
+        rowRange = pointRange
+    else:
+        rowRange = None
     
-        centroids, dst = optFeatureDetector(img, subPixel = subpixelFitting, featureType = detectionType)
-        
-        centroids = np.hstack((centroids, angleStep*k*np.ones((len(centroids), 1))))
+    for k, img, centroids, dst in detectPlanes(planes, detectionType, subpixelFitting, workers, rowRange):
         
+        print('Analyzing plane {}'.format(k))
         
         # Add feature transform image to accumulation image
-        if len(dstAccum) == 0:
-            dstAccum = np.array(dst)
-            imgAccum = np.array(img.astype('float32'))
-        else:
-            dstAccum = dstAccum + dst
-            imgAccum = imgAccum + img.astype('float32')
+        if dstAccum is None:
+            dstAccum = np.zeros(dst.shape, dtype='float32')
+            imgAccum = np.zeros(img.shape, dtype='float32')
+            
+        dstAccum += dst
+        imgAccum += img
         
         # Keep feature points corresponding to desired feature
         # Exclude all points with Y values outside of pointRange
@@ -165,26 +552,26 @@ def main(imgFolder, imgStep, detectionType, subpixelFitting):
             
             # Keep points in this range.
             
-            keepPoint = centroids[(centroids[:,1] > np.amin(pointRange)) & (centroids[:,1] < np.amax(pointRange)),:]
+            keep = (centroids[:,1] > np.amin(pointRange)) & (centroids[:,1] < np.amax(pointRange))
             
+        elif len(pointRange) == 0 and detectionType == 'bead':
             
-            if len(cornerList) == 0:
-                cornerList = np.array(keepPoint)
-            else:
-                cornerList = np.append(cornerList, keepPoint, axis = 0)
+            # Every bead is tracked
             
+            keep = np.ones(len(centroids), dtype=bool)
             
         elif len(pointRange) == 0:
         
             # Point is the centroid farthest down in the image
     
-            if len(cornerList) == 0:
-                cornerList = np.array(centroids[centroids[:,1] == np.amax(centroids[:,1]), :])
-            else:
-                cornerList = np.append(cornerList, centroids[centroids[:,1] == np.amax(centroids[:,1]), :], axis = 0)
+            keep = centroids[:,1] == np.amax(centroids[:,1])
                 
         else:
-            raise('Point range not supported')
+            raise ValueError('Point range not supported')
+            
+        cornerBuffer, numCorners = appendPoints(cornerBuffer, numCorners, centroids[keep,:], angleStep*k)
+
+    cornerList = cornerBuffer[:numCorners]
 
     return dstAccum, cornerList
 
@@ -207,52 +594,190 @@ def printOutput(ellipseParams, cornerList, suggestCorrections):
     # Next set assumes pin starts on far left (operator looking at sample along optical axis)
     # Pin rotates away from camera at first half of measurement.
     # Front-back measurements. 
+    summary = summarizeCornerList(cornerList)
+    
     print('---------------------------------')
     print('Front-back measurements:')
-    print('StdDev = {}'.format( np.std(cornerList[:,1])))
-    print('Std first half = {}'.format( np.std(cornerList[:int(len(cornerList)/2), 1])))
-    print('Mean first half = {}'.format( np.mean(cornerList[:int(len(cornerList)/2), 1])))
-    print('Std secnd half = {}'.format(np.std(cornerList[int(len(cornerList)/2):, 1])))
-    print('Mean secnd half = {}'.format(np.mean(cornerList[int(len(cornerList)/2):, 1])))
+    print('StdDev = {}'.format(summary['stdAll']))
+    print('Std first half = {}'.format(summary['stdFirstHalf']))
+    print('Mean first half = {}'.format(summary['meanFirstHalf']))
+    print('Std secnd half = {}'.format(summary['stdSecondHalf']))
+    print('Mean secnd half = {}'.format(summary['meanSecondHalf']))
     
     # Left-right measurements. 
     print('---------------------------------')
     print('Left-right measurements:')
-    print('Std first quad = {}'.format(np.std(cornerList[int(len(cornerList)/8):2*int(len(cornerList)/8), 1])))
-    print('Mean first quad = {}'.format( np.mean(cornerList[int(len(cornerList)/8):2*int(len(cornerList)/8), 1])))
-    print('Std third quad = {}'.format(np.std(cornerList[5*int(len(cornerList)/8):6*int(len(cornerList)/8), 1])))
-    print('Mean third quad = {}'.format(np.mean(cornerList[5*int(len(cornerList)/8):6*int(len(cornerList)/8), 1])))
+    print('Std first quad = {}'.format(summary['stdFirstQuad']))
+    print('Mean first quad = {}'.format(summary['meanFirstQuad']))
+    print('Std third quad = {}'.format(summary['stdThirdQuad']))
+    print('Mean third quad = {}'.format(summary['meanThirdQuad']))
     print('---------------------------------')
     
     
     if suggestCorrections['output']:
-        # Calculate amounts to offset mounting to correct measured position errors
-        leftRight = suggestCorrections['stageCorners'][0]*np.tan(phi)
+        for message in computeCorrections(ellipseParams, suggestCorrections)['messages']:
+            print(message)
+            
+        print('---------------------------------')
         
-        # Projection of circle onto plane yielding ellipse is r cos \theta, where r is radius of circle
-        # Assume major axis is radius of circle
-        projTheta = (np.pi/2) - np.arccos(axes[1]/axes[0])
-        frontBack = suggestCorrections['stageCorners'][1]*np.tan(projTheta)
+def summarizeCornerList(cornerList):
+    # Spread of the point y position over parts of the rotation, as reported by printOutput
+    
+    half = int(len(cornerList)/2)
+    eighth = int(len(cornerList)/8)
+    y = cornerList[:,1]
+    
+    return {'stdAll': np.std(y),
+            'stdFirstHalf': np.std(y[:half]),
+            'meanFirstHalf': np.mean(y[:half]),
+            'stdSecondHalf': np.std(y[half:]),
+            'meanSecondHalf': np.mean(y[half:]),
+            'stdFirstQuad': np.std(y[eighth:2*eighth]),
+            'meanFirstQuad': np.mean(y[eighth:2*eighth]),
+            'stdThirdQuad': np.std(y[5*eighth:6*eighth]),
+            'meanThirdQuad': np.mean(y[5*eighth:6*eighth])}
+
+def computeCorrections(ellipseParams, suggestCorrections):
+    # Calculate amounts to offset mounting to correct measured position errors
+    # Returns dict with 'leftRight' and 'frontBack' shim heights in mm and printable 'messages'
+    
+    axes = ellipseParams[2:4]
+    phi = np.radians(ellipseParams[4]) # Fitted ellipse angle is in degrees
+    
+    leftRight = suggestCorrections['stageCorners'][0]*np.tan(phi)
+    
+    # Projection of circle onto plane yielding ellipse is r cos \theta, where r is radius of circle
+    # Assume major axis is radius of circle
+    projTheta = (np.pi/2) - np.arccos(axes[1]/axes[0])
+    frontBack = suggestCorrections['stageCorners'][1]*np.tan(projTheta)
+    
+    messages = []
+    
+    if suggestCorrections['rotatesTowards'] == 'back':
+       messages.append('Raise front {} mm relative to back.'.format(frontBack))
+    elif suggestCorrections['rotatesTowards'] == 'front':
+       messages.append('Raise back {} mm relative to front.'.format(frontBack))
+    else:
+        messages.append('Variable rotateTowards can have values \'front\' or \'back\'')
         
-        if suggestCorrections['rotatesTowards'] == 'back':
-           print('Raise front {} mm relative to back.'.format(frontBack))
+    if suggestCorrections['specimenStartSide'] == 'left':
+        messages.append('Raise left {} mm relative to right.'.format(leftRight))
+    elif suggestCorrections['specimenStartSide'] == 'right':
+        messages.append('Raise right {} mm relative to left.'.format(leftRight))
+    else:
+        messages.append('Variable specimenStartSize can have values \'right\' or \'left\'') 
         
-        elif suggestCorrections['rotatesTowards'] == 'front':
-           print('Raise back {} mm relative to front.'.format(frontBack))
-        else:
-            print('Variable rotateTowards can have values \'front\' or \'back\'')
+    return {'leftRight': leftRight, 'frontBack': frontBack, 'messages': messages}
+
+def streamAlignment(acqFolder, planesPerRotation, suggestCorrections, pointRange = [], invertImg = False,
+                    rotateFrame = True, subpixelFitting = True, minPoints = 8, pollInterval = 0.5, robust = False,
+                    channel = None):
+    # Live alignment. Watches acqFolder for single-plane tif files as they are acquired,
+    # as written by optacq.bsh when streamDirName is set (<id>_<channel>_NNNN.tif),
+    # detects the test object corner in each and updates the ellipse fit incrementally from
+    # running scatter matrix sums, printing suggested stage corrections after every plane.
+    #
+    # Sums cover the most recent planesPerRotation planes, so corrections follow
+    # adjustments made to the mount during acquisition.
+    # rotateFrame - rotate raw camera frames as done for MicroManager stacks in readPlanes
+    # robust - refit the window with fitEllipseRobust instead of using the running sums
+    # channel - only use files with this in their name, e.g. 'trans'
+    # Multipage stacks (the MicroManager stack saved at the end of acquisition) are skipped.
+    # Runs until interrupted with Ctrl-C. Returns the points in the current window.
+    
+    seen = set()
+    sizes = {}
+    window = deque()
+    S = np.zeros((6,6))
+    numPoints = 0
+    
+    rowRange = pointRange if len(pointRange) == 2 else None
+    # Whole-frame corner response range, taken from the first plane
+    responseRange = None
+    
+    print('Watching ' + acqFolder + ' for planes. Ctrl-C to stop.')
+    
+    try:
+        while True:
             
-        if suggestCorrections['specimenStartSide'] == 'left':
-            print('Raise left {} mm relative to right.'.format(leftRight))
-        elif suggestCorrections['specimenStartSide'] == 'right':
-            print('Raise right {} mm relative to left.'.format(leftRight))
-        else:
-            print('Variable specimenStartSize can have values \'right\' or \'left\'') 
+            newFiles = sorted([f for f in os.listdir(acqFolder) if f.endswith('.tif') and f not in seen
+                               and (channel is None or channel in f)])
             
-        print('---------------------------------')
+            for f in newFiles:
+                
+                # Leave files that are still growing for the next poll
+                size = os.path.getsize(os.path.join(acqFolder, f))
+                if sizes.get(f) != size:
+                    sizes[f] = size
+                    continue
+                
+                seen.add(f)
+                
+                with tifffile.TiffFile(os.path.join(acqFolder, f)) as tif:
+                    numPages = len(tif.pages)
+                    img = tif.pages[0].asarray()
+                    
+                if numPages > 1 or img.ndim != 2:
+                    print('Skipping ' + f + ', not a single plane')
+                    continue
+                
+                if rotateFrame:
+                    img = np.rot90(img, -1)
+                    
+                if invertImg:
+                    img = np.flipud(img)
+                    
+                if responseRange is None and rowRange is not None:
+                    responseRange = cornerResponseRange(img)
+                    
+                centroids, dst = optFeatureDetector(img, subPixel = subpixelFitting, rowRange = rowRange,
+                                                    responseRange = responseRange)
+                
+                if rowRange is not None:
+                    points = centroids[(centroids[:,1] > np.amin(pointRange)) & (centroids[:,1] < np.amax(pointRange)),:]
+                else:
+                    points = centroids[centroids[:,1] == np.amax(centroids[:,1]), :]
+                
+                # Add this plane to the running sums and drop the plane one rotation back
+                planeScatter = ellipseScatter(points)
+                window.append((points, planeScatter))
+                S += planeScatter
+                numPoints += len(points)
+                
+                if len(window) > planesPerRotation:
+                    oldPoints, oldScatter = window.popleft()
+                    S -= oldScatter
+                    numPoints -= len(oldPoints)
+                    
+                if numPoints < minPoints:
+                    print('{}: {} points, waiting for more'.format(f, numPoints))
+                    continue
+                
+                try:
+                    if robust:
+                        params, ellCoord, stats = fitEllipseRobust(np.vstack([points for points, planeScatter in window]))
+                    else:
+                        params, ellCoord = fitEllipseFromScatter(S)
+                except (np.linalg.LinAlgError, ValueError):
+                    continue
+                
+                corrections = computeCorrections(params, suggestCorrections)
+                
+                if robust:
+                    print('{}: {} of {} points are inliers, rms {:.2f} px'.format(f, stats['numInliers'], numPoints, stats['rmsResidual']))
+                
+                print('{}: {} points, center ({:.1f}, {:.1f}), axes ({:.1f}, {:.1f}), angle {:.3f} | {}'.format(
+                      f, numPoints, params[0], params[1], params[2], params[3], params[4], ' '.join(corrections['messages'])))
+            
+            time.sleep(pollInterval)
+            
+    except KeyboardInterrupt:
+        print('Stopped.')
+        
+    return np.vstack([points for points, planeScatter in window]) if len(window) > 0 else np.zeros((0, 2))
         
-def plotOutput(dstAccum, cornerList, elipFit):
-    # Make plots    
+def plotOutput(dstAccum, cornerList, elipFit, savePath = None, title = None):
+    # Make plots. Saves to savePath without showing if given, otherwise blocks on plt.show()
     plt.cla()
     plt.imshow(dstAccum)
     plt.plot(cornerList[:,0], cornerList[:,1], 'wx')
@@ -261,7 +786,15 @@ def plotOutput(dstAccum, cornerList, elipFit):
     #elipFit = ellipse(R, center[0], center[1], axes[0], axes[1], phi)
     
     plt.plot(elipFit[:,0], elipFit[:,1], 'w-')
-    plt.show()
+    
+    if title is not None:
+        plt.title(title)
+    
+    if savePath is None:
+        plt.show()
+    else:
+        plt.savefig(savePath, dpi = 150)
+        plt.close()
     
 
 #%%
@@ -282,7 +815,7 @@ if __name__ == "__main__":
     imgStep = 11 # interval between images to sample. 
     
     detectionType = 'corner' # 'corner' will look for sharp corner, such as point on object
-                             # To do : 'bead' for contrasting bead in specimen
+                             # 'bead' for contrasting beads in specimen. Every bead is tracked across angles
     
     subpixelFitting = True
     
@@ -296,14 +829,41 @@ if __name__ == "__main__":
                                                   # If looking from top, objective lens on left, pointing to right, specimen starts at 12 o'clock position and rotates clockwise, this is 'back'
     suggestCorrections['specimenStartSide'] = 'left' # From camera perpsective
     
+    streaming = False # Watch imgFolder during acquisition and update corrections live
+                      # Set imgFolder to streamDirName in optacq.bsh
+    planesPerRotation = 400 # Planes in one full rotation, used as the live fitting window
+    
+    robustFitting = True # RANSAC ellipse fit, ignoring spurious corners
+    
+    if streaming:
+        streamAlignment(imgFolder, planesPerRotation, suggestCorrections, pointRange = pointRange,
+                        invertImg = invertImg, subpixelFitting = subpixelFitting, robust = robustFitting,
+                        channel = 'trans')
+        raise SystemExit
+    
     #%%
     # Detect features and return filtered image, detected points
-    dstAccum, cornerList = main(imgFolder, imgStep, detectionType, subpixelFitting)
+    dstAccum, cornerList = main(imgFolder, imgStep, detectionType, subpixelFitting,
+                                invertImg = invertImg, pointRange = pointRange)
     
     #%% Fit point to ellipse 
     
     #center, axes, phi = fitEllipse(cornerList[:,0], cornerList[:,1])
-    params, elipFit = fitEllipseCorrected(cornerList[:,0:2])
+    if detectionType == 'bead':
+        tracks = trackBeads(cornerList)
+        params, beadFits = fitBeadTracks(cornerList, tracks)
+        print('Fitted {} bead tracks. Angle std {:.3f} deg, axis ratio std {:.4f}'.format(
+              len(beadFits), np.std(beadFits[:,4]), np.std(beadFits[:,3]/beadFits[:,2])))
+        
+        # Per-plane statistics and plot use the longest track
+        cornerList = cornerList[max(tracks, key=len)]
+        trackParams, elipFit, fitStats = fitEllipseRobust(cornerList[:,0:2])
+    elif robustFitting:
+        params, elipFit, fitStats = fitEllipseRobust(cornerList[:,0:2])
+        print('Robust fit: {} of {} points are inliers, rms residual {:.2f} px'.format(
+              fitStats['numInliers'], fitStats['numPoints'], fitStats['rmsResidual']))
+    else:
+        params, elipFit = fitEllipseCorrected(cornerList[:,0:2])
     printOutput(params, cornerList, suggestCorrections)
     plotOutput(dstAccum, cornerList, elipFit)
 
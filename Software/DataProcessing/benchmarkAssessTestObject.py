@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of result accumulation in assessTestObject.main.
+
+Compares the former pattern (np.append onto cornerList and non-in-place addition into
+dstAccum/imgAccum) with preallocated buffers and in-place accumulation, on synthetic
+detector output at increasing sampling density. Detection itself is not timed.
+
+Usage:
+    python benchmarkAssessTestObject.py [frameSize]
+
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from assessTestObject import appendPoints
+
+
+def accumulateAppend(planes):
+    # Former accumulation in main, kept here as the reference
+
+    cornerList = np.array([])
+    dstAccum = np.array([])
+    imgAccum = np.array([])
+
+    for angle, img, centroids, dst in planes:
+
+        if len(dstAccum) == 0:
+            dstAccum = np.array(dst)
+            imgAccum = np.array(img.astype('float32'))
+        else:
+            dstAccum = dstAccum + dst
+            imgAccum = imgAccum + img.astype('float32')
+
+        keepPoint = np.hstack((centroids, angle*np.ones((len(centroids), 1))))
+
+        if len(cornerList) == 0:
+            cornerList = np.array(keepPoint)
+        else:
+            cornerList = np.append(cornerList, keepPoint, axis = 0)
+
+    return dstAccum, cornerList
+
+def accumulatePreallocated(planes, numSampled):
+    # Accumulation as now done in main
+
+    cornerBuffer = np.empty((numSampled, 3))
+    numCorners = 0
+    dstAccum = None
+    imgAccum = None
+
+    for angle, img, centroids, dst in planes:
+
+        if dstAccum is None:
+            dstAccum = np.zeros(dst.shape, dtype='float32')
+            imgAccum = np.zeros(img.shape, dtype='float32')
+
+        dstAccum += dst
+        imgAccum += img
+
+        cornerBuffer, numCorners = appendPoints(cornerBuffer, numCorners, centroids, angle)
+
+    return dstAccum, cornerBuffer[:numCorners]
+
+def syntheticPlanes(numSampled, frameSize, pointsPerPlane = 2):
+    # Reuse one image and dst so the benchmark measures accumulation, not data generation
+
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 4096, (frameSize, frameSize)).astype('uint16')
+    dst = rng.rand(frameSize, frameSize).astype('float32')
+    centroids = rng.rand(pointsPerPlane, 2)*frameSize
+
+    angleStep = 2*np.pi/numSampled
+
+    return [(k*angleStep, img, centroids, dst) for k in range(numSampled)]
+
+def timeIt(func, repeats = 3):
+
+    best = np.inf
+
+    for r in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+def main(argv):
+
+    frameSize = int(argv[0]) if len(argv) > 0 else 512
+
+    print('Frame size {0} x {0}'.format(frameSize))
+    print('{:>8} {:>12} {:>12} {:>8}'.format('planes', 'append (s)', 'prealloc (s)', 'speedup'))
+
+    for numSampled in [100, 400, 1600, 6400]:
+
+        planes = syntheticPlanes(numSampled, frameSize)
+
+        tAppend, (dstA, cornersA) = timeIt(lambda: accumulateAppend(planes))
+        tPrealloc, (dstP, cornersP) = timeIt(lambda: accumulatePreallocated(planes, numSampled))
+
+        # Both strategies must give the same result
+        assert np.array_equal(cornersA, cornersP)
+        assert np.allclose(dstA, dstP)
+
+        print('{:>8} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(numSampled, tAppend, tPrealloc, tAppend/tPrealloc))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
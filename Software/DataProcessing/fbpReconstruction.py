@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Filtered backprojection reconstruction of deplaned OPT projections.
+
+Replaces the NRecon step for parallel-beam OPT data. Reads the imgRot_XXXX.tif
+projections written by stackToPlanes and writes one 8-bit imgRot__recXXXXXXXX.tif
+per detector row into the 'recon' folder, the layout opt_volume_creator expects.
+
+Runs headless; slices are reconstructed in parallel across worker processes.
+
+Usage:
+    python fbpReconstruction.py <path_to_native_folder> [--processes N]
+
+"""
+
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import numpy as np
+import tifffile
+
+import rotationCenter
+
+
+# Worker state, populated by _initWorker in each reconstruction process
+_workerState = {}
+
+
+def listProjections(projectionFolder):
+    # Sorted list of deplaned projection files, imgRot_XXXX.tif
+
+    return sorted([f for f in os.listdir(projectionFolder) if re.match(r'imgRot_\d{4}\.tif$', f)])
+
+def loadProjections(projectionFolder, stackFile):
+    # Copy all projections into a single (angle, row, column) .npy stack on disk
+    # so worker processes can memory-map it instead of each reading every file.
+
+    fileList = listProjections(projectionFolder)
+
+    if len(fileList) == 0:
+        raise IOError('No imgRot_XXXX.tif projections found in ' + projectionFolder)
+
+    first = tifffile.imread(os.path.join(projectionFolder, fileList[0]))
+
+    stack = np.lib.format.open_memmap(stackFile, mode='w+', dtype=first.dtype,
+                                      shape=(len(fileList),) + first.shape)
+
+    for k, f in enumerate(fileList):
+        stack[k] = tifffile.imread(os.path.join(projectionFolder, f))
+
+    stack.flush()
+    shape = stack.shape
+    del stack
+
+    return shape
+
+def rampFilter(numDetector, window = 'ram-lak'):
+    # Frequency response of the reconstruction filter, zero-padded to at least
+    # twice the detector width to avoid wrap-around in the circular convolution.
+
+    padSize = int(2**np.ceil(np.log2(2*numDetector)))
+
+    freq = np.fft.rfftfreq(padSize)
+    filt = np.abs(freq)
+
+    if window == 'shepp-logan':
+        filt[1:] = filt[1:]*np.sinc(freq[1:])
+    elif window == 'hann':
+        filt = filt*(0.5 + 0.5*np.cos(2*np.pi*freq))
+    elif window != 'ram-lak':
+        raise ValueError('Filter window must be \'ram-lak\', \'shepp-logan\' or \'hann\'')
+
+    return filt.astype('float32'), padSize
+
+def toLineIntegrals(projections, logTransform):
+    # Convert raw projection intensities to line integrals
+    # Transmission images are attenuation: -log(I/I0), with I0 taken as the bright background
+    # Fluorescence images are emission and are used linearly after background removal
+    # Both references are taken per detector row so results do not depend on how rows are blocked
+
+    projections = projections.astype('float32')
+
+    if logTransform:
+        flat = np.percentile(projections, 99.9, axis=-1, keepdims=True)
+        projections = -np.log(np.clip(projections/flat, 1e-6, 1))
+    else:
+        projections = projections - np.percentile(projections, 0.1, axis=-1, keepdims=True)
+
+    return projections
+
+def filterSinograms(sinograms, filt, padSize):
+    # Filter all sinograms in a (angle, row, column) block at once along the detector axis
+
+    numDetector = sinograms.shape[-1]
+
+    spectrum = np.fft.rfft(sinograms, n=padSize, axis=-1)
+    spectrum *= filt
+
+    return np.fft.irfft(spectrum, n=padSize, axis=-1)[..., :numDetector].astype('float32')
+
+def backprojectSlice(sinogram, cosAngles, sinAngles, center, outputSize):
+    # Backproject one filtered (angle, column) sinogram onto an outputSize x outputSize grid
+    # with linear interpolation along the detector, vectorized over all pixels per angle
+
+    numDetector = sinogram.shape[1]
+
+    coords = np.arange(outputSize, dtype='float32') - (outputSize - 1)/2.
+    X, Y = coords[None, :], coords[:, None]
+
+    recon = np.zeros((outputSize, outputSize), dtype='float32')
+
+    for a in range(len(cosAngles)):
+
+        u = X*cosAngles[a] + Y*sinAngles[a] + center
+
+        u0 = np.floor(u)
+        w = u - u0
+        u0 = u0.astype('intp')
+
+        inside = (u0 >= 0) & (u0 < numDetector - 1)
+        u0[~inside] = 0
+
+        row = sinogram[a]
+        recon += np.where(inside, (1 - w)*row[u0] + w*row[u0 + 1], 0)
+
+    return recon*(np.pi/len(cosAngles))
+
+def _initWorker(stackFile, params):
+
+    _workerState['stack'] = np.load(stackFile, mmap_mode='r')
+    _workerState['params'] = params
+
+    filt, padSize = rampFilter(_workerState['stack'].shape[2], params['window'])
+    _workerState['filter'] = filt
+    _workerState['padSize'] = padSize
+
+    angles = params['angles']
+    _workerState['cos'] = np.cos(angles).astype('float32')
+    _workerState['sin'] = np.sin(angles).astype('float32')
+
+def _reconstructBlock(rows):
+    # Reconstruct a contiguous block of detector rows. Returns float slices if no
+    # output folder is given, otherwise writes 8-bit tifs and returns the row range.
+
+    stack = _workerState['stack']
+    params = _workerState['params']
+
+    sinograms = toLineIntegrals(stack[:, rows[0]:rows[1], :], params['logTransform'])
+    sinograms = filterSinograms(sinograms, _workerState['filter'], _workerState['padSize'])
+
+    # Axis position for each row, following the tilt about the central row
+    rowOffset = np.arange(rows[0], rows[1]) - (stack.shape[1] - 1)/2.
+    centers = (stack.shape[2] - 1)/2. + params['centerOffset'] + np.tan(np.radians(params['tilt']))*rowOffset
+
+    slices = []
+
+    for r in range(rows[1] - rows[0]):
+
+        recon = backprojectSlice(sinograms[:, r, :], _workerState['cos'], _workerState['sin'],
+                                 centers[r], params['outputSize'])
+
+        if params['outputFolder'] is None:
+            slices.append(recon)
+        else:
+            saveName = 'imgRot__rec' + format(rows[0] + r, '08d') + '.tif'
+            tifffile.imwrite(os.path.join(params['outputFolder'], saveName),
+                             scaleToUint8(recon, params['intensityRange']))
+
+    if params['outputFolder'] is None:
+        return rows, slices
+    else:
+        return rows, None
+
+def scaleToUint8(recon, intensityRange):
+
+    low, high = intensityRange
+
+    return (255*np.clip((recon - low)/(high - low), 0, 1)).astype('uint8')
+
+def reconstructFolder(projectionFolder, outputFolder = None, centerOffset = None, tilt = None,
+                      logTransform = None, window = 'ram-lak', intensityRange = None,
+                      rotationDirection = 'CC', blockRows = 8, processes = None):
+    # Reconstruct every detector row of a deplaned projection folder
+    #
+    # projectionFolder - folder with imgRot_XXXX.tif projections (e.g. <mouse>/trans/native)
+    # outputFolder - where to write imgRot__recXXXXXXXX.tif; defaults to projectionFolder/recon
+    # centerOffset - rotation axis position relative to the detector center, in pixels
+    # tilt - rotation axis tilt in degrees
+    #   centerOffset and tilt default to the values in imgRot_.log (see rotationCenter), else 0
+    # logTransform - treat projections as transmission images. Default: True unless path contains 'fluor'
+    # intensityRange - (low, high) mapped to 0-255 in output. Default: percentiles of the central slice
+    # rotationDirection - 'CC' or 'CW'; 'CW' mirrors the reconstructed slices
+    # blockRows - detector rows filtered together in each work unit
+    # processes - worker processes. Default: all cores
+
+    if outputFolder is None:
+        outputFolder = os.path.join(projectionFolder, 'recon')
+
+    if not os.path.isdir(outputFolder):
+        os.makedirs(outputFolder)
+
+    if logTransform is None:
+        logTransform = 'fluor' not in projectionFolder
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    logFile = os.path.join(projectionFolder, 'imgRot_.log')
+
+    if os.path.isfile(logFile):
+        logOffset, logTilt = rotationCenter.readRotationCenter(logFile)
+    else:
+        logOffset, logTilt = 0., 0.
+
+    if centerOffset is None:
+        centerOffset = logOffset
+
+    if tilt is None:
+        tilt = logTilt
+
+    startTime = time.time()
+
+    stackFile = os.path.join(outputFolder, 'projections.tmp.npy')
+    numAngles, numRows, numDetector = loadProjections(projectionFolder, stackFile)
+
+    print('Loaded {} projections of {} x {} in {:.1f} s'.format(numAngles, numRows, numDetector,
+                                                                 time.time() - startTime))
+
+    if rotationDirection == 'CC':
+        direction = 1
+    elif rotationDirection == 'CW':
+        direction = -1
+    else:
+        raise ValueError('Rotation direction must be \'CC\' or \'CW\'')
+
+    # Projections span a full 360 degree rotation
+    params = {'angles': direction*np.arange(numAngles)*2*np.pi/numAngles,
+              'centerOffset': centerOffset,
+              'tilt': tilt,
+              'logTransform': logTransform,
+              'window': window,
+              'outputSize': numDetector,
+              'outputFolder': None,
+              'intensityRange': intensityRange}
+
+    try:
+        if intensityRange is None:
+            # Set output scaling from the central slice, as done in the NRecon preview
+            _initWorker(stackFile, params)
+            rows, slices = _reconstructBlock((numRows//2, numRows//2 + 1))
+            params['intensityRange'] = tuple(np.percentile(slices[0], [0.5, 99.9]))
+            _workerState.clear()
+
+        params['outputFolder'] = outputFolder
+
+        blocks = [(r, min(r + blockRows, numRows)) for r in range(0, numRows, blockRows)]
+
+        with multiprocessing.Pool(processes, initializer=_initWorker, initargs=(stackFile, params)) as pool:
+            for k, (rows, _) in enumerate(pool.imap_unordered(_reconstructBlock, blocks)):
+                if k % 16 == 0:
+                    print('Reconstructed rows {}-{} ({}/{} blocks)'.format(rows[0], rows[1] - 1, k + 1, len(blocks)))
+    finally:
+        os.remove(stackFile)
+
+    print('Reconstructed {} slices into {} in {:.1f} s'.format(numRows, outputFolder, time.time() - startTime))
+
+    return True
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='Filtered backprojection of deplaned OPT projections')
+    parser.add_argument('projectionFolder', help='folder containing imgRot_XXXX.tif projections')
+    parser.add_argument('--output', default=None, help='output folder (default: <projectionFolder>/recon)')
+    parser.add_argument('--center-offset', type=float, default=None, help='rotation axis offset from detector center, pixels (default: from imgRot_.log)')
+    parser.add_argument('--tilt', type=float, default=None, help='rotation axis tilt, degrees (default: from imgRot_.log)')
+    parser.add_argument('--window', default='ram-lak', help='ram-lak, shepp-logan or hann')
+    parser.add_argument('--range', type=float, nargs=2, default=None, help='intensity range mapped to 0-255')
+    parser.add_argument('--direction', default='CC', help='rotation direction, CC or CW')
+    parser.add_argument('--block-rows', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    reconstructFolder(args.projectionFolder, outputFolder = args.output, centerOffset = args.center_offset, tilt = args.tilt,
+                      window = args.window, intensityRange = args.range,
+                      rotationDirection = args.direction, blockRows = args.block_rows, processes = args.processes)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Read and update NRecon-style reconstruction log files (imgRot_.log).
+
+Log files are INI-like: [Section] headers, Key=Value lines and ';' comment lines.
+Comments and unrelated lines are preserved when values are updated.
+
+"""
+
+import re
+
+
+def readReconLog(logFile):
+    # Return {section: {key: value}} with values as strings
+
+    log = {}
+    section = None
+
+    with open(logFile, 'r', encoding='latin-1') as f:
+        for line in f:
+            line = line.strip()
+
+            header = re.match(r'^\[(.+)\]$', line)
+
+            if header:
+                section = header.group(1)
+                log.setdefault(section, {})
+            elif section is not None and '=' in line and not line.startswith(';'):
+                key, value = line.split('=', 1)
+                log[section][key.strip()] = value.strip()
+
+    return log
+
+def updateReconLog(logFile, section, values, comments = {}):
+    # Set Key=Value entries in a section, replacing existing keys and creating the
+    # section before the end-of-file marker if needed.
+    # comments - optional {key: comment} written on the line after a new key
+
+    with open(logFile, 'r', encoding='latin-1') as f:
+        lines = f.read().splitlines()
+
+    remaining = dict(values)
+    currentSection = None
+    sectionEnd = None
+
+    for k, line in enumerate(lines):
+        stripped = line.strip()
+        header = re.match(r'^\[(.+)\]$', stripped)
+
+        if header:
+            if currentSection == section:
+                sectionEnd = k
+            currentSection = header.group(1)
+            continue
+
+        if currentSection == section and '=' in stripped and not stripped.startswith(';'):
+            key = stripped.split('=', 1)[0].strip()
+            if key in remaining:
+                lines[k] = key + '=' + str(remaining.pop(key))
+
+    if currentSection == section and sectionEnd is None:
+        sectionEnd = len(lines)
+        while sectionEnd > 0 and lines[sectionEnd - 1].startswith('#'):
+            sectionEnd -= 1
+
+    newLines = []
+    for key, value in remaining.items():
+        newLines.append(key + '=' + str(value))
+        if key in comments:
+            newLines.append('; ' + comments[key])
+
+    if sectionEnd is None:
+        # Section does not exist. Add it before the '# End of log file' marker
+        sectionEnd = len(lines)
+        while sectionEnd > 0 and lines[sectionEnd - 1].startswith('#'):
+            sectionEnd -= 1
+        newLines = ['[' + section + ']'] + newLines
+
+    lines[sectionEnd:sectionEnd] = newLines
+
+    with open(logFile, 'w', encoding='latin-1') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return True
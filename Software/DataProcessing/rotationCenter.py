@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Estimate the rotation axis position and tilt of an OPT acquisition from the data itself.
+
+Projections 180 degrees apart are mirror images of each other about the rotation axis.
+Mirroring the opposing projection and cross-correlating it with the first, row by row,
+gives twice the axis offset from the detector center for each row. A line fit over rows
+gives the offset at the central row and the tilt of the axis.
+
+Works on images in the deplaned orientation (rows along the rotation axis).
+
+"""
+
+import numpy as np
+import tifffile
+
+import reconLog
+
+
+def rowShifts(proj0, proj180, rows):
+    # FFT cross-correlation of each selected row of proj0 with the mirrored row of proj180
+    # Returns the subpixel shift and normalized correlation peak height for each row
+
+    a = proj0[rows, :].astype('float64')
+    b = proj180[rows, ::-1].astype('float64')
+
+    a = a - a.mean(axis=1, keepdims=True)
+    b = b - b.mean(axis=1, keepdims=True)
+
+    numDetector = a.shape[1]
+    padSize = 2*numDetector
+
+    xcorr = np.fft.irfft(np.fft.rfft(b, padSize, axis=1)*np.conj(np.fft.rfft(a, padSize, axis=1)), padSize, axis=1)
+
+    norm = np.sqrt(np.sum(a*a, axis=1)*np.sum(b*b, axis=1))
+    norm[norm == 0] = np.inf
+
+    peak = np.argmax(xcorr, axis=1)
+    rowIdx = np.arange(len(rows))
+
+    # Parabolic interpolation around the correlation peak
+    left = xcorr[rowIdx, (peak - 1) % padSize]
+    center = xcorr[rowIdx, peak]
+    right = xcorr[rowIdx, (peak + 1) % padSize]
+
+    denom = left - 2*center + right
+    denom[denom == 0] = np.inf
+    subPixel = 0.5*(left - right)/denom
+
+    # Circular lags above padSize/2 are negative shifts
+    shift = np.where(peak > padSize//2, peak - padSize, peak) + subPixel
+
+    return -shift, center/norm
+
+def estimateRotationCenter(proj0, proj180, rowStep = 16, minCorrelation = 0.5):
+    # Estimate rotation axis offset (pixels, relative to detector center) and tilt (degrees)
+    #
+    # proj0, proj180 - projections 180 degrees apart, deplaned orientation
+    # rowStep - sample every rowStep-th row
+    # minCorrelation - rows with a weaker normalized correlation peak are ignored
+    #
+    # Returns offset, tilt and the number of rows used in the fit.
+    # Offset is given at the central row; positive is toward higher column index.
+    # Tilt is the angle of the axis from the row direction, positive when the axis moves
+    # toward higher columns at higher rows.
+
+    rows = np.arange(rowStep//2, proj0.shape[0], rowStep)
+
+    shifts, quality = rowShifts(proj0, proj180, rows)
+
+    good = quality > minCorrelation
+
+    if np.sum(good) < 2:
+        raise ValueError('Too few rows with usable signal to estimate rotation center')
+
+    rowCenter = (proj0.shape[0] - 1)/2.
+
+    # Offset of the axis is half the shift between mirrored projections
+    slope, offset = np.polyfit(rows[good] - rowCenter, shifts[good]/2., 1)
+
+    return offset, np.degrees(np.arctan(slope)), np.sum(good)
+
+def estimateStackRotationCenter(inputFile, rowStep = 16, numPairs = 4):
+    # Estimate rotation center from a raw MicroManager stack covering 360 degrees
+    # Uses numPairs evenly spaced opposing-projection pairs and takes the median
+
+    offsets = []
+    tilts = []
+
+    with tifffile.TiffFile(inputFile) as tif:
+        numPages = len(tif.pages)
+        half = numPages//2
+
+        for k in np.linspace(0, half, numPairs, endpoint=False).astype('int'):
+            # Transpose to match deplaned orientation written by stackToPlanes
+            proj0 = tif.pages[k].asarray().T
+            proj180 = tif.pages[k + half].asarray().T
+
+            try:
+                offset, tilt, numRows = estimateRotationCenter(proj0, proj180, rowStep)
+            except ValueError:
+                continue
+
+            offsets.append(offset)
+            tilts.append(tilt)
+
+    if len(offsets) == 0:
+        raise ValueError('Could not estimate rotation center for ' + inputFile)
+
+    return np.median(offsets), np.median(tilts)
+
+def writeRotationCenter(logFile, centerOffset, tilt):
+    # Record estimated rotation center in the reconstruction log
+
+    values = {'Rotation Center Offset (pixels)': '{:.2f}'.format(centerOffset),
+              'Rotation Axis Tilt (deg)': '{:.4f}'.format(tilt)}
+
+    comments = {'Rotation Center Offset (pixels)': 'Non-standard key. Estimated from opposing projections. Axis position relative to detector center',
+                'Rotation Axis Tilt (deg)': 'Non-standard key. Estimated from opposing projections'}
+
+    return reconLog.updateReconLog(logFile, 'Reconstruction', values, comments)
+
+def readRotationCenter(logFile):
+    # Return (centerOffset, tilt) recorded in a reconstruction log, (0, 0) if absent
+
+    section = reconLog.readReconLog(logFile).get('Reconstruction', {})
+
+    return (float(section.get('Rotation Center Offset (pixels)', 0)),
+            float(section.get('Rotation Axis Tilt (deg)', 0)))
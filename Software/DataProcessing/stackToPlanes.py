@@ -14,10 +14,23 @@ Created on Thu Jun 07 15:46:51 2018
 
 import tifffile
 import os
+import re
+import json
+import shutil
+import signal
+import time
+import multiprocessing
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import fbpReconstruction
+import rotationCenter
 #import skimage.filters as filt
 
 
+MANIFEST_NAME = 'deplane_manifest.json'
+
+
 def genBkgdImg(bkgdImage):
 
     with tifffile.TiffFile(bkgdImage) as tif:
@@ -27,10 +40,155 @@ def genBkgdImg(bkgdImage):
             
     return bkgd
 
-def stackToOPTPlanes(inputFile, outputFolder, doBackground = False, bkgdDict = {}, includeDownsample = False):
+def writePlane(fileName, img, compression = None):
+    # Write one plane, optionally with lossless compression. Returns bytes written.
+    # compression - None, 'deflate' or 'zstd'. Integer images use horizontal predictor.
+    # Deflate TIFFs are widely readable; zstd needs imagecodecs and may not open in NRecon.
+    
+    if compression is None:
+        tifffile.imwrite(fileName, img)
+    else:
+        if compression == 'deflate':
+            compression = 'zlib'
+        
+        tifffile.imwrite(fileName, img, compression = compression,
+                         predictor = np.issubdtype(img.dtype, np.integer))
+    
+    return os.path.getsize(fileName)
+
+def stackSignature(inputFile, numPages, options):
+    # Identify a source stack and the options used to deplane it
+    
+    stat = os.stat(inputFile)
+    
+    return {'source': os.path.abspath(inputFile),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'pages': numPages,
+            'options': options}
+
+def readManifest(outputFolder):
+    
+    manifestFile = os.path.join(outputFolder, MANIFEST_NAME)
+    
+    if os.path.isfile(manifestFile):
+        try:
+            with open(manifestFile, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            # Truncated by an interrupted write. Treat as absent.
+            return None
+    
+    return None
+
+def saveManifest(outputFolder, manifest):
+    # Replace the manifest atomically so an interruption never leaves it half written
+    
+    manifestFile = os.path.join(outputFolder, MANIFEST_NAME)
+    
+    with open(manifestFile + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 2)
+        
+    os.replace(manifestFile + '.tmp', manifestFile)
+
+def writeManifest(outputFolder, signature, completedPages):
+    # Record deplaning progress. Post-deplaning steps start over whenever planes are rewritten
+    
+    manifest = dict(signature)
+    manifest['completedPages'] = completedPages
+    manifest['complete'] = completedPages == signature['pages']
+    manifest['steps'] = []
+    
+    saveManifest(outputFolder, manifest)
+
+def recordStep(outputFolder, step):
+    # Mark a post-deplaning step (recon log, center estimate, reconstruction) as done
+    
+    manifest = readManifest(outputFolder)
+    
+    if manifest is not None and step not in manifest.get('steps', []):
+        manifest.setdefault('steps', []).append(step)
+        saveManifest(outputFolder, manifest)
+
+def completedSteps(outputFolder):
+    
+    manifest = readManifest(outputFolder)
+    
+    if manifest is None:
+        return []
+    
+    return manifest.get('steps', [])
+
+def removeStalePlanes(planeFolder, numPages):
+    # Delete planes left from an earlier, longer version of the stack
     
-    with tifffile.TiffFile(inputFile) as tif:
-        for k in range(len(tif.pages)):
+    if not os.path.isdir(planeFolder):
+        return
+    
+    for f in os.listdir(planeFolder):
+        match = re.match(r'imgRot_(\d{4})\.tif$', f)
+        
+        if match and int(match.group(1)) >= numPages:
+            os.remove(os.path.join(planeFolder, f))
+
+def stackToOPTPlanes(inputFile, outputFolder, doBackground = False, bkgdDict = {}, includeDownsample = False,
+                     compression = None, writeThreads = 4, manifestInterval = 20):
+    # Planes are encoded and written on a thread pool while the next page is read.
+    # Progress is recorded in a manifest in outputFolder every manifestInterval pages.
+    # A stack whose manifest matches the source file and options is skipped, and an
+    # interrupted stack resumes after its last completed page.
+    # Returns dict of write statistics for the stack.
+    
+    if not os.path.isdir(os.path.split(outputFolder)[0]):
+        os.mkdir(os.path.split(outputFolder)[0])
+    
+    if not os.path.isdir(outputFolder):
+        os.mkdir(outputFolder)
+    
+    if not os.path.isdir(os.path.join(outputFolder, 'native')):
+        os.mkdir(os.path.join(outputFolder, 'native'))
+        
+    if not os.path.isdir(os.path.join(outputFolder, 'native', 'recon')):
+        os.mkdir(os.path.join(outputFolder, 'native', 'recon'))
+    
+    if includeDownsample:
+        if not os.path.isdir(os.path.join(outputFolder, 'downsample')):
+            os.mkdir(os.path.join(outputFolder, 'downsample'))
+            
+        if not os.path.isdir(os.path.join(outputFolder, 'downsample', 'recon')):
+            os.mkdir(os.path.join(outputFolder, 'downsample', 'recon'))
+    
+    startTime = time.time()
+    rawBytes = 0
+    writtenBytes = 0
+    pending = deque()
+    
+    options = {'doBackground': doBackground,
+               'includeDownsample': includeDownsample,
+               'compression': compression}
+    
+    with tifffile.TiffFile(inputFile) as tif, ThreadPoolExecutor(max_workers = writeThreads) as pool:
+        numPages = len(tif.pages)
+        
+        signature = stackSignature(inputFile, numPages, options)
+        manifest = readManifest(outputFolder)
+        
+        startPage = 0
+        
+        if manifest is not None and all(manifest.get(key) == value for key, value in signature.items()):
+            if manifest['complete']:
+                print('Skipping ' + inputFile + ', already deplaned')
+                return {'planes': 0, 'rawBytes': 0, 'writtenBytes': 0, 'seconds': 0., 'skipped': True}
+            
+            startPage = manifest['completedPages']
+            print('Resuming ' + inputFile + ' at page {}'.format(startPage))
+        
+        removeStalePlanes(os.path.join(outputFolder, 'native'), numPages)
+        removeStalePlanes(os.path.join(outputFolder, 'downsample'), numPages)
+        
+        completedPages = startPage
+        
+        for k in range(startPage, numPages):
             saveName = 'imgRot_' + format(int(k), '04d') + '.tif'
             
             img = tif.pages[k].asarray()
@@ -55,38 +213,48 @@ def stackToOPTPlanes(inputFile, outputFolder, doBackground = False, bkgdDict = {
             imgToSave = img[:, range(0, img.shape[1], 4)]
             imgToSave = imgToSave[range(0, img.shape[0], 4), :]
             
-            if not os.path.isdir(os.path.split(outputFolder)[0]):
-                os.mkdir(os.path.split(outputFolder)[0])
-            
-            if not os.path.isdir(outputFolder):
-                os.mkdir(outputFolder)
-            
-            if not os.path.isdir(os.path.join(outputFolder, 'native')):
-                os.mkdir(os.path.join(outputFolder, 'native'))
+            # Pages are stored with each write so the manifest only advances past fully written pages
+            pending.append((k, pool.submit(writePlane, os.path.join(outputFolder, 'native', saveName), img.T, compression)))
+            rawBytes += img.nbytes
                 
-            if not os.path.isdir(os.path.join(outputFolder, 'native', 'recon')):
-                os.mkdir(os.path.join(outputFolder, 'native', 'recon'))
-            
-            tifffile.imsave(os.path.join(outputFolder, 'native', saveName), img.T)
+            if includeDownsample:
+                pending.append((k, pool.submit(writePlane, os.path.join(outputFolder, 'downsample', saveName), imgToSave.T, compression)))
+                rawBytes += imgToSave.nbytes
             
+            # Bound the number of planes held in memory waiting to be written
+            while len(pending) > 2*writeThreads:
+                page, future = pending.popleft()
+                writtenBytes += future.result()
                 
-            if includeDownsample:
-                if not os.path.isdir(os.path.join(outputFolder, 'downsample')):
-                    os.mkdir(os.path.join(outputFolder, 'downsample'))
+                if len(pending) == 0 or pending[0][0] != page:
+                    completedPages = page + 1
                     
-                if not os.path.isdir(os.path.join(outputFolder, 'downsample', 'recon')):
-                    os.mkdir(os.path.join(outputFolder, 'downsample', 'recon'))
-                    
-                tifffile.imsave(os.path.join(outputFolder, 'downsample', saveName), imgToSave.T)
-                
-            
+                    if completedPages % manifestInterval == 0:
+                        writeManifest(outputFolder, signature, completedPages)
+        
+        while len(pending) > 0:
+            page, future = pending.popleft()
+            writtenBytes += future.result()
+        
+        writeManifest(outputFolder, signature, numPages)
+    
+    elapsed = time.time() - startTime
+    
+    stats = {'planes': numPages - startPage,
+             'rawBytes': rawBytes,
+             'writtenBytes': writtenBytes,
+             'seconds': elapsed,
+             'skipped': False}
+    
+    print('Wrote {} planes: {:.1f} MB on disk ({:.0f}% of uncompressed) in {:.1f} s, {:.1f} MB/s'.format(
+          stats['planes'], writtenBytes/1e6, 100.*writtenBytes/max(rawBytes, 1), elapsed, rawBytes/1e6/max(elapsed, 1e-6)))
             
-    return True
+    return stats
             
 def copyDummyReconFile(dummyReconLogFile, outputFolder):
             
-    if not dummyReconLogFile in os.listdir(os.path.join(outputFolder, 'native')):
-        os.system('copy ' + dummyReconLogFile + ' ' +  os.path.join(outputFolder, 'native', 'imgRot_.log'))
+    if not 'imgRot_.log' in os.listdir(os.path.join(outputFolder, 'native')):
+        shutil.copyfile(dummyReconLogFile, os.path.join(outputFolder, 'native', 'imgRot_.log'))
         
     return True
 
@@ -149,13 +317,137 @@ def parseInputFolder(inputFolder):
     return fileList
         
         
+def processStack(inputFile, outPath, options):
+    # Deplane one stack and run the post-deplaning steps selected in options
+    # options - dict with keys doBackgroundSub, bkgdDict, compression, alignmentOnly,
+    #           dummyReconLogFile, estimateCenter, doReconstruction (see main)
+    # Each post-deplaning step is recorded in the manifest when it finishes, so a run
+    # interrupted after deplaning picks up at the first step not yet done.
+    
+    out1 = stackToOPTPlanes(inputFile, outPath, doBackground = options['doBackgroundSub'], bkgdDict = options['bkgdDict'],
+                            compression = options['compression'])
+    
+    if out1 and not options['alignmentOnly']:
+        
+        steps = completedSteps(outPath)
+        
+        if 'reconLog' not in steps:
+            
+            out2 = copyDummyReconFile(options['dummyReconLogFile'], outPath)
+            
+            if out2:
+                
+                recordStep(outPath, 'reconLog')
+                print('Successfully deplaned ' + inputFile)
+            
+        if options['estimateCenter'] and 'estimateCenter' not in steps:
+            
+            try:
+                centerOffset, tilt = rotationCenter.estimateStackRotationCenter(inputFile)
+                rotationCenter.writeRotationCenter(os.path.join(outPath, 'native', 'imgRot_.log'), centerOffset, tilt)
+                recordStep(outPath, 'estimateCenter')
+                print('Rotation center offset {:.2f} px, tilt {:.3f} deg'.format(centerOffset, tilt))
+            except ValueError as e:
+                print(e)
+            
+        if options['doReconstruction'] and 'reconstruction' not in steps:
+            
+            fbpReconstruction.reconstructFolder(os.path.join(outPath, 'native'))
+            recordStep(outPath, 'reconstruction')
+         
+    else:
+        print("Exited stack deleaving for input " + inputFile)
+        
+    return out1
+
+def isStackFinished(inputFile, history, stableChecks):
+    # A stack is finished when its size and mtime have not changed over stableChecks
+    # polls and no other process holds it open for writing.
+    # history - dict of inputFile -> [(size, mtime), ...], updated in place
+    
+    stat = os.stat(inputFile)
+    
+    seen = history.setdefault(inputFile, [])
+    seen.append((stat.st_size, stat.st_mtime))
+    del seen[:-stableChecks]
+    
+    if len(seen) < stableChecks or len(set(seen)) > 1:
+        return False
+    
+    # On Windows, renaming a file onto itself fails while MicroManager still has it open
+    try:
+        os.rename(inputFile, inputFile)
+    except OSError:
+        return False
+    
+    return True
+
+def ignoreInterrupt():
+    # Pool initializer. Ctrl-C only stops the watch, workers finish the stack they are writing
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def watchInputFolder(inputFolder, outputFolder, options, pollInterval = 10, stableChecks = 3, workers = 1):
+    # Watch an acquisition folder and deplane each stack as soon as it is finished
+    # Deplaning runs in background processes so it overlaps with the next acquisition.
+    # Runs until interrupted with Ctrl-C, then waits for stacks in progress.
+    
+    history = {}
+    submitted = {}
+    reported = set()
+    
+    print('Watching ' + inputFolder + ' for finished stacks. Ctrl-C to stop.')
+    
+    pool = multiprocessing.Pool(workers, initializer = ignoreInterrupt)
+    
+    try:
+        while True:
+            
+            for f in parseInputFolder(inputFolder):
+                
+                inputFile = os.path.join(inputFolder, f[0], f[-1])
+                outPath = os.path.join(outputFolder, f[1], f[2])
+                
+                if inputFile in submitted or not os.path.isfile(inputFile):
+                    continue
+                
+                if isStackFinished(inputFile, history, stableChecks):
+                    print('Queueing ' + inputFile)
+                    submitted[inputFile] = pool.apply_async(processStack, (inputFile, outPath, options))
+            
+            for inputFile, result in submitted.items():
+                if result.ready() and inputFile not in reported:
+                    reported.add(inputFile)
+                    try:
+                        result.get()
+                    except Exception as e:
+                        print('Failed to deplane ' + inputFile + ': ' + repr(e))
+            
+            time.sleep(pollInterval)
+            
+    except KeyboardInterrupt:
+        print('Stopping watch. Waiting for stacks in progress...')
+        
+    finally:
+        pool.close()
+        pool.join()
+    
+    return submitted
+        
 def main():
     
     inputFolder = r'F:\dyiOPT\20191014'
     outputFolder = r'D:\Data\diyOPT\20191014'
     
+    watchMode = False # Keep running and deplane stacks as acquisitions finish
+    
     alignmentOnly = False
     
+    compression = None # None, 'deflate' or 'zstd' for lossless compression of deplaned planes
+    
+    doReconstruction = False # Reconstruct with fbpReconstruction instead of NRecon
+    
+    estimateCenter = True # Estimate rotation center from opposing projections and write to recon log
+    
     dummyReconLogFile = r'C:\Users\ScanningLabAnalysis\Documents\Python\diyOPT\imgRot_.log'
     
     doBackgroundSub = False
@@ -167,6 +459,18 @@ def main():
     else:
         bkgdDict = {}
         
+    options = {'doBackgroundSub': doBackgroundSub,
+               'bkgdDict': bkgdDict,
+               'compression': compression,
+               'alignmentOnly': alignmentOnly,
+               'dummyReconLogFile': dummyReconLogFile,
+               'estimateCenter': estimateCenter,
+               'doReconstruction': doReconstruction}
+    
+    if watchMode:
+        watchInputFolder(inputFolder, outputFolder, options)
+        return
+        
     fileList = parseInputFolder(inputFolder)
     
     for f in fileList:
@@ -176,22 +480,10 @@ def main():
         
         if os.path.isfile(inputFile):
     
-            out1 = stackToOPTPlanes(inputFile, outPath, doBackground = doBackgroundSub, bkgdDict = bkgdDict)
-            
-            if out1 and not alignmentOnly:
-                
-                out2 = copyDummyReconFile(dummyReconLogFile, outPath)
-                
-                if out2:
-                    
-                    print('Successfully deplaned ' + inputFile)
-                 
-            else:
-                print("Exited stack deleaving for input " + inputFile)
+            processStack(inputFile, outPath, options)
                 
         else:
             print('Path ' + os.path.join(inputFolder, f[0]) + ' does not contain valid stack file.')
 
 if __name__ == "__main__":
     main()
-        